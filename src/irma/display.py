@@ -1,7 +1,7 @@
 import numpy as np
 from matplotlib import pyplot as plt
 from .room import find_echoes, find_dir, irstats
-from .process import spectrum, spectrogram, fconvolve
+from .process import spectrum, spectrogram, fconvolve, smooth_spectrum, pyramid_tile
 from IPython.display import display, HTML
 plt.style.use('dark_background')
 
@@ -166,11 +166,16 @@ def acorr_plot(data, trange=0.2, fs=48000):
     axs[n].set_xlabel('Time (ms)')
     return axs, fig
 
-def spectrum_plot(data, logscale=False, fmax=12000, fs=48000, lrange=60, figsize=None, overlay=True, axs=None, labels=None):
+def spectrum_plot(data, logscale=False, fmax=12000, fs=48000, lrange=60, figsize=None, overlay=True, axs=None, labels=None, smooth=None):
+    '''
+    smooth: suaviza con 1/smooth de octava sobre una grilla logaritmica (ver smooth_spectrum)
+    '''
     if data.ndim == 1:
         data = data[:,np.newaxis] # el array debe ser 2D
     _, nchan = data.shape
-    sp = spectrum(data, fs=fs)
+    sp = spectrum(data, fs=fs, outputs=('s',))
+    if smooth is not None:
+        sp['f'], sp['s'] = smooth_spectrum(sp['s'], sp['f'], noct=smooth, db=True, logf=True, fmin=10.0)
     if figsize is None:
         figsize = (18,3*nchan)
     if axs is None:    
@@ -216,6 +221,41 @@ def spectrogram_plot(data,window,overlap,fs,chan=0,fmax=22000,tmax=2.0,normalize
     fig.colorbar(ctr)
     return ax, fig
 
+def spectrogram_zoom_plot(pyr,chan=0,fmax=None,tmax=None,lrange=60,figsize=(20,8),ax=None):
+    '''
+    Grafica el espectrograma a partir de la piramide pyr (process.spectrogram_pyramid o load_pyramid)
+    y al hacer zoom o desplazar los ejes reemplaza la imagen por el tile con la resolucion necesaria
+    para el tamano de los ejes, sin recalcular el espectrograma
+    '''
+    if ax is None:
+        fig, ax = plt.subplots(figsize=figsize)
+    else:
+        fig = ax.figure
+    f, t, _ = pyr['levels'][-1]
+    maxlevel = 10*np.log10(pyr['smax'][chan])
+    im = ax.imshow(np.zeros((2,2)),origin='lower',aspect='auto',interpolation='nearest',
+                   vmin=maxlevel-lrange,vmax=maxlevel)
+    ax.set_autoscale_on(False)
+    ax.set_xlim([0,tmax or t[-1]])
+    ax.set_ylim([0,fmax or pyr['fs']/2])
+    def update(ax):
+        t0, t1 = ax.get_xlim()
+        f0, f1 = ax.get_ylim()
+        bbox = ax.get_window_extent()
+        ft, tt, st = pyramid_tile(pyr,t0,t1,f0,f1,npixt=int(bbox.width),npixf=int(bbox.height),chan=chan)
+        if len(tt) < 2 or len(ft) < 2:
+            return
+        im.set_data(10*np.log10(np.maximum(st,np.finfo(np.float32).tiny)))
+        im.set_extent([tt[0],tt[-1],ft[0],ft[-1]])
+        ax.figure.canvas.draw_idle()
+    update(ax)
+    ax.callbacks.connect('xlim_changed',update)
+    ax.callbacks.connect('ylim_changed',update)
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Frequency (Hz)')
+    fig.colorbar(im,ax=ax)
+    return ax, fig
+
 def pars_plot(pars, keys, chan=1):
     # busca la ocurrencia de 'RT' 'EDT' 'SNR' 'C80' 'C50' 'TS' 'DRR' en keys
     rtype = list(filter(lambda x: 'rt' in x, pars.keys()))
@@ -346,7 +386,10 @@ def parsdecay_plot(pars, chan=1, fs=48000):
     return axs, fig            
 
     
-def transfer_plot(data,f=None,logscale=False, fmax=6000, fmin=60,fs=48000, lrange=60, overlay=True):
+def transfer_plot(data,f=None,logscale=False, fmax=6000, fmin=60,fs=48000, lrange=60, overlay=True, smooth=None):
+    '''
+    smooth: suaviza con 1/smooth de octava (potencia y fase desenrollada) sobre una grilla logaritmica
+    '''
     if type(data) == dict:
         f = data['f']
         H = data['H']
@@ -366,6 +409,10 @@ def transfer_plot(data,f=None,logscale=False, fmax=6000, fmin=60,fs=48000, lrang
     H = H[nmin:nmax]
     f = f[nmin:nmax]
     HdB = 20*np.log10(np.abs(H))
+    phase = np.unwrap(np.angle(H),axis=0)
+    if smooth is not None:
+        _, HdB = smooth_spectrum(HdB, f, noct=smooth, db=True, logf=True, fmin=f[0], axis=0)
+        f, phase = smooth_spectrum(phase, f, noct=smooth, logf=True, fmin=f[0], axis=0)
     smax = np.max(HdB)
     smin = smax-lrange
     for n in range(nchan):
@@ -373,10 +420,10 @@ def transfer_plot(data,f=None,logscale=False, fmax=6000, fmin=60,fs=48000, lrang
         ax2 = axs[2*n+1]
         if logscale:
             ax1.semilogx(f,HdB[:,n],label=str(n))
-            ax2.semilogx(f,np.unwrap(np.angle(H[:,n])),label=str(n))
+            ax2.semilogx(f,phase[:,n],label=str(n))
         else:
             ax1.plot(f,HdB[:,n],label=str(n))
-            ax2.plot(f,np.unwrap(np.angle(H[:,n])),label=str(n))  
+            ax2.plot(f,phase[:,n],label=str(n))  
         ax1.set_ylim([smin,smax])
         ax1.legend()
         ax2.legend() 
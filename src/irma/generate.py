@@ -1,20 +1,65 @@
+import os
+import json
+import hashlib
 import numpy as np
 from scipy import signal
 from scipy.fft import next_fast_len,fft,ifft,rfft,irfft
 from scipy.io import wavfile
+from scipy.signal import oaconvolve
 from .process import fadeinout, burst
 
 
-def sweep(T, f1=30, f2=22000,filename=None,fs=48000,Nrep=1,order=2,post=2.0,rms=-3.2):
+def sweep(T, f1=30, f2=22000,filename=None,fs=48000,Nrep=1,order=2,post=2.0,rms=-3.2,real=True):
     '''
     Genera un sweep exponencial de duracion T con frecuencia de sampleo fs desde la frecuencia f1
     hasta f2, lo almacena en filename.wav y guarda el filtro inverso en filename_inv.npy
     como parametros opcionales se pueden modificar el fadein y fadeout de la senal con fade
     usa el metodo de Muller and Massarani, "Transfer Function Measurement with Sweeps" 
     que era el implementado en Matlab. El unico cambio es que puede elegirse el orden del filtro
+    Con real=True (por defecto) la longitud se elige rapida para rfft y se guarda solo el espectro 
+    de un lado (invsweeprfft) del filtro inverso, con real=False el espectro completo (invsweepfft)
     '''
     if filename is None:
         filename = 'sweep' + str(T) + 's_' + str(f1) + '_' + str(f2)   
+    sweep, filters, tsweep, gdlaw = _sweep_signal(T,f1,f2,fs,order,post,rms,real)
+    invsweepfft = _sweep_inverse(sweep,filters,fs,real)
+    print('Sweep generated with {0} samples.'.format(len(sweep)))
+    print('Total signal with {0} repetitions has a duration of {1:.2f} seconds'.format(Nrep,Nrep*len(sweep)/fs))
+    if real:
+        np.savez(filename + '_inv',invsweeprfft=invsweepfft,nfft=len(sweep),type='sweep',fs=fs,Nrep=Nrep,
+                 f1=f1,f2=f2,tsweep=tsweep,gdlaw=gdlaw) 
+    else:
+        np.savez(filename + '_inv',invsweepfft=invsweepfft,type='sweep',fs=fs,Nrep=Nrep,f1=f1,f2=f2,tsweep=tsweep,
+                 gdlaw=gdlaw) 
+    wavfile.write(filename + '.wav',fs,np.tile(sweep,Nrep)) # guarda el sweep en wav con formato float 32 bits
+    return sweep
+
+def sweep_library(T=10.0,f1=30,f2=22000,fs=48000,Nrep=1,order=2,post=2.0,rms=-3.2,libpath=None):
+    '''
+    Devuelve el prefijo (sin extension) del sweep con estos parametros dentro de la biblioteca de 
+    excitaciones libpath (por defecto la variable de entorno IRMA_LIBRARY o ~/.irma/excitations).
+    El nombre incluye un hash de todos los parametros y el sweep (wav e _inv.npz) solo se genera
+    si todavia no esta en la biblioteca, sino se usan los archivos existentes sin leerlos.
+    '''
+    if libpath is None:
+        libpath = os.environ.get('IRMA_LIBRARY',os.path.join(os.path.expanduser('~'),'.irma','excitations'))
+    pars = dict(T=float(T),f1=float(f1),f2=float(f2),fs=int(fs),Nrep=int(Nrep),order=int(order),
+                post=None if post is None else float(post),rms=float(rms),real=True)
+    key = hashlib.sha1(json.dumps(pars,sort_keys=True).encode()).hexdigest()[:12]
+    filename = os.path.join(libpath,f"sweep_x{pars['Nrep']}_{pars['fs']//1000}k_{pars['T']:g}s_{pars['f1']:g}_{pars['f2']:g}_{key}")
+    if os.path.exists(filename + '.wav') and os.path.exists(filename + '_inv.npz'):
+        print("using sweep " + filename)
+    else:
+        os.makedirs(libpath,exist_ok=True)
+        sweep(T,f1,f2,filename=filename,fs=fs,Nrep=Nrep,order=order,post=post,rms=rms)
+    return filename
+
+def _sweep_signal(T,f1,f2,fs,order,post,rms,real):
+    '''
+    arma el sweep (ver sweep) y devuelve la senal, los filtros pasabanda usados para el filtro inverso,
+    la duracion del barrido propiamente dicho tsweep (sin fadein ni fadeout) y la ley tiempo-frecuencia
+    gdlaw (2 x 512: frecuencias en escala log entre f1/2 y fs/2, instante en segundos de cada una)
+    '''
     N = int(T*fs)
     Gd_start = int(np.ceil(min(N/10,max(fs/f1, N/200)))) # inicio del group delay fs/f1 acotado entre N/10 y N/200
     postfade = int(np.ceil(min(N/10,max(fs/f2,N/200)))) # fadeout 
@@ -36,6 +81,8 @@ def sweep(T, f1=30, f2=22000,filename=None,fs=48000,Nrep=1,order=2,post=2.0,rms=
     mag = mag*np.abs(H1)*np.abs(H2) # y aplicamos pasabanda\
     Gd = tsweep * np.cumsum(mag**2)/np.sum(mag**2) # calculo del group delay
     Gd = Gd + Gd_start/fs # agrega el predelay
+    fgd = np.geomspace(f1/2,fs/2,512)
+    gdlaw = np.vstack((fgd,np.interp(fgd,W1,Gd))) # instante de cada frecuencia en segundos
     Gd = Gd*fs/2;   # convierte a samples
     ph = -2.0*np.pi*np.cumsum(Gd)/(N+1) # obtiene la fase integrando el GD
     ph = ph - (W1/(fs/2))*np.mod(ph[-1],2.0*np.pi) # fuerza la fase a terminar en multiplo de 2 pi
@@ -46,12 +93,13 @@ def sweep(T, f1=30, f2=22000,filename=None,fs=48000,Nrep=1,order=2,post=2.0,rms=
     
     if post is not None: # zeropadding for better accuracy
         npost = int(fs*post)
-        NL = next_fast_len(N+npost)
+        NL = next_fast_len(N+npost,real)
     else:    
-        NL = next_fast_len(N)
+        npost = 0
+        NL = next_fast_len(N,real)
     if NL>len(sweep):
         print("PAD")
-        np.pad(sweep,(0,NL-len(sweep)))    
+        sweep = np.pad(sweep,(0,NL-len(sweep)))    
     else:
         sweep = sweep[:NL]
     rms_sweep = 10.0*np.log10(np.mean(np.square(sweep[:NL-npost]))) # deberia ser -3 dB
@@ -66,22 +114,145 @@ def sweep(T, f1=30, f2=22000,filename=None,fs=48000,Nrep=1,order=2,post=2.0,rms=
     sweep[:Gd_start] = sweep[:Gd_start]*w[:Gd_start]
     w = signal.hann(2*postfade) # ventana para fadeout
     sweep[-postfade:] = sweep[-postfade:]*w[-postfade:]
+    return sweep, (B1,A1,B2,A2), tsweep, gdlaw
+
+def _sweep_inverse(sweep,filters,fs,real=True):
+    '''
+    calcula el espectro del filtro inverso del sweep (de un lado si real es True) con el pasabanda
+    '''
+    B1, A1, B2, A2 = filters
+    NL = len(sweep)
     # Calculo del filtro inverso normalizado
-    sweepfft = fft(sweep)
+    if real:
+        sweepfft = rfft(sweep)
+        fr = np.arange(NL//2+1)*fs/NL
+        W1, H1 = signal.freqz(B1,A1,fr,fs=fs)
+        W2, H2 = signal.freqz(B2,A2,fr,fs=fs)
+    else:
+        sweepfft = fft(sweep)
+        W1, H1 = signal.freqz(B1,A1,NL,whole=True,fs=fs)
+        W2, H2 = signal.freqz(B2,A2,NL,whole=True,fs=fs)
     invsweepfft = 1.0/sweepfft
     #  para evitar divergencias re aplicamos el pasabanda
-    W1, H1 = signal.freqz(B1,A1,NL,whole=True,fs=fs)
-    W2, H2 = signal.freqz(B2,A2,NL,whole=True,fs=fs)
     invsweepfftmag  = np.abs(invsweepfft)*np.abs(H1)*np.abs(H2)
     invsweepfftphase = np.angle(invsweepfft)
     invsweepfft = invsweepfftmag*np.exp(1.0j*invsweepfftphase) # resintesis
-    print('Sweep generated with {0} samples.'.format(len(sweep)))
-    print('Total signal with {0} repetitions has a duration of {1:.2f} seconds'.format(Nrep,Nrep*len(sweep)/fs))
-    np.savez(filename + '_inv',invsweepfft=invsweepfft,type='sweep',fs=fs,Nrep=Nrep) 
-    wavfile.write(filename + '.wav',fs,np.tile(sweep,Nrep)) # guarda el sweep en wav con formato float 32 bits
-    return sweep
+    return invsweepfft
+
+def mesm(T, nspk, tir=2.0, f1=30, f2=22000, filename=None, fs=48000, Nrep=1, order=2, post=None, rms=-3.2):
+    '''
+    Multiple exponential sweep method (interleaved): genera una senal de nspk canales en la que 
+    cada parlante reproduce el mismo sweep de duracion T retrasado tir segundos respecto del anterior, 
+    de modo que todos los parlantes se miden en una sola captura y una sola deconvolucion.
+    tir debe ser mayor que la duracion de la IR mas la de las IR armonicas (que quedan antes de la 
+    IR lineal de cada parlante). post es el silencio luego del ultimo sweep (tir por defecto).
+    Guarda la senal multicanal en filename.wav y el filtro inverso (type 'mesm') en filename_inv.npz
+    '''
+    if filename is None:
+        filename = 'mesm' + str(nspk) + '_' + str(T) + 's_' + str(f1) + '_' + str(f2)
+    if post is None:
+        post = tir
+    ntau = int(tir*fs)
+    sweep, filters, tsweep, gdlaw = _sweep_signal(T,f1,f2,fs,order,post,rms,True)
+    L = next_fast_len(len(sweep)+(nspk-1)*ntau,True)
+    sweep = np.pad(sweep,(0,L-len(sweep)))
+    invsweepfft = _sweep_inverse(sweep,filters,fs,True)
+    excitation = np.stack([np.roll(sweep,n*ntau) for n in range(nspk)],axis=1)
+    print('MESM signal generated for {0} speakers with {1} samples.'.format(nspk,L))
+    print('Total signal with {0} repetitions has a duration of {1:.2f} seconds'.format(Nrep,Nrep*L/fs))
+    np.savez(filename + '_inv',invsweeprfft=invsweepfft,nfft=L,type='mesm',fs=fs,Nrep=Nrep,nspk=nspk,ntau=ntau,
+             f1=f1,f2=f2,tsweep=tsweep,gdlaw=gdlaw)
+    wavfile.write(filename + '.wav',fs,np.tile(excitation,(Nrep,1)))
+    return excitation
+
+#Maximum length sequences
+def mls(filename,N=16,fs=48000,Nrep=1):
+    '''
+    Genera una secuencia de maxima longitud (MLS) de orden N (2**N-1 muestras) y la almacena 
+    repetida Nrep+1 veces en filename.wav (el primer periodo lleva el sistema a regimen periodico 
+    y se descarta en la extraccion). En filename_inv.npz guarda las tablas de permutacion 
+    para deconvolucionar con la transformada rapida de Hadamard (process.ir_mls)
+    '''
+    seq, _ = signal.max_len_seq(N)
+    L = len(seq)
+    # ventanas de N muestras consecutivas (estados del registro) como enteros
+    states = np.zeros(L,dtype=np.int64)
+    for k in range(N):
+        states += np.roll(seq,-k).astype(np.int64) << k
+    # permutacion de entrada: la muestra j va a la columna states[j] de la matriz de Hadamard
+    perm_in = states
+    # permutacion de salida a partir de las posiciones donde el estado es un vector unitario
+    where = np.zeros(L+1,dtype=np.int64)
+    where[states] = np.arange(L)
+    pos = where[1 << np.arange(N)]
+    rows = np.zeros(L,dtype=np.int64)
+    for k in range(N):
+        rows += np.roll(seq,-pos[k]).astype(np.int64) << k
+    perm_out = rows[(-np.arange(L)) % L] # retardo n -> fila (-n mod L)
+    x = 1.0-2.0*seq
+    print('MLS generated with {0} samples.'.format(L))
+    print('Total signal with {0}+1 repetitions has a duration of {1:.2f} seconds'.format(Nrep,(Nrep+1)*L/fs))
+    np.savez(filename + '_inv',perm_in=perm_in,perm_out=perm_out,order=N,type='mls',fs=fs,Nrep=Nrep)
+    wavfile.write(filename + '.wav',fs,np.tile(x,Nrep+1)*0.999) 
+    return x
 
 # Multitone
+def multisine(filename,T=1.0,f1=20,f2=20000,fs=48000,nper=4,grid='lin',nlines=1000,phase='schroeder',
+              amp='flat',crest_iter=100,seed=None):
+    '''
+    Genera un multiseno periodico de periodo T con frecuencias entre f1 y f2 en la grilla del periodo
+    grid: 'lin' (todas las frecuencias), 'odd' (solo armonicos impares de 1/T) o 'log' (nlines 
+    frecuencias espaciadas logaritmicamente). amp: 'flat' o 'pink'. Las fases iniciales son de 
+    Schroeder (phase='schroeder') o aleatorias ('random', con semilla seed) y luego se optimiza el 
+    factor de cresta por recorte iterativo durante crest_iter iteraciones.
+    Guarda nper+1 periodos en filename.wav (el primero se descarta en la extraccion) y las lineas
+    excitadas con su espectro en filename_inv.npz (type 'multisine')
+    '''
+    P = int(T*fs)
+    k1 = max(1,int(np.ceil(f1*P/fs)))
+    k2 = min(P//2,int(np.floor(f2*P/fs)))
+    if grid == 'lin':
+        bins = np.arange(k1,k2+1)
+    elif grid == 'odd':
+        bins = np.arange(k1+1-k1%2,k2+1,2)
+    elif grid == 'log':
+        bins = np.unique(np.round(np.geomspace(k1,k2,nlines)).astype(int))
+    else:
+        raise ValueError("grid must be 'lin', 'odd' or 'log'")
+    if amp == 'flat':
+        A = np.ones(len(bins))
+    elif amp == 'pink':
+        A = 1.0/np.sqrt(bins)
+    else:
+        raise ValueError("amp must be 'flat' or 'pink'")
+    K = len(bins)
+    if phase == 'schroeder':
+        ph = -np.pi*np.arange(K)*(np.arange(K)+1)/K
+    elif phase == 'random':
+        ph = np.random.default_rng(seed).uniform(-np.pi,np.pi,K)
+    else:
+        raise ValueError("phase must be 'schroeder' or 'random'")
+    X = np.zeros(P//2+1,dtype=complex)
+    X[bins] = A*np.exp(1.0j*ph)
+    x = irfft(X,P)
+    best = x
+    crest = np.max(np.abs(x))/np.sqrt(np.mean(np.square(x)))
+    for n in range(crest_iter):
+        # recorta los picos y conserva solo la fase de las lineas excitadas
+        xc = np.clip(x,-0.8*np.max(np.abs(x)),0.8*np.max(np.abs(x)))
+        X[bins] = A*np.exp(1.0j*np.angle(rfft(xc)[bins]))
+        x = irfft(X,P)
+        c = np.max(np.abs(x))/np.sqrt(np.mean(np.square(x)))
+        if c < crest:
+            crest = c
+            best = x
+    x = 0.999*best/np.max(np.abs(best))
+    print('Multisine generated with {0} lines and {1} samples per period, crest factor {2:.2f} dB'.format(K,P,20*np.log10(crest)))
+    print('Total signal with {0}+1 periods has a duration of {1:.2f} seconds'.format(nper,(nper+1)*P/fs))
+    np.savez(filename + '_inv',bins=bins,Xref=rfft(x)[bins],nfft=P,type='multisine',fs=fs,Nrep=nper)
+    wavfile.write(filename + '.wav',fs,np.tile(x,nper+1))
+    return x
+
 
 #Golay complementary sequences
 def golay(filename,N=18,fs=48000, Nrep=1):
@@ -122,28 +293,126 @@ def whitenoise(T, flow=None, fhigh=None, fslow=None, fshigh=None, nchannels=1, f
     nsamples = int(fs*T)
     freqs = np.fft.rfftfreq(nsamples, 1/fs)
     freqs[0] = 1/nsamples
+    gain = _band_gain(freqs,flow,fhigh,fslow,fshigh)
+    real = gain*np.random.randn(nchannels, freqs.shape[0])
+    imag = gain*np.random.randn(nchannels, freqs.shape[0])
+    if not nsamples & 1:
+        imag[-1] = 0.
+    wnoise = np.array(np.fft.irfft(real + 1j*imag),ndmin=2, dtype='float64').T
+    wnoise /= np.abs(wnoise).max(axis=0)
+    fadeinout(wnoise, fadein=fadein, fadeout=fadeout, fs=fs)
+    if filename is not None:
+        wavfile.write(filename + '.wav',fs,wnoise) 
+    return wnoise
+
+def _band_gain(freqs, flow=None, fhigh=None, fslow=None, fshigh=None):
+    '''
+    ganancia de la banda entre flow y fhigh con bordes sigmoideos (ver whitenoise)
+    '''
     fmax = freqs[-1]
+    gain = np.ones_like(freqs)
     if flow is not None:
         if fslow is None:
             fslow=flow
-        s1 = sigmoid(freqs/fmax,flow/fmax,fslow/fmax)
-    else:
-        s1 = 1
+        gain *= sigmoid(freqs/fmax,flow/fmax,fslow/fmax)
     if fhigh is not None:
         if fshigh is None:
             fshigh=fhigh/4.0
-        s2 = sigmoid(freqs/fmax,fhigh/fmax,-fshigh/fmax)
+        gain *= sigmoid(freqs/fmax,fhigh/fmax,-fshigh/fmax)
+    return gain
+
+def _channel_rngs(seed, nchannels):
+    ''' generadores independientes (y reproducibles con seed) para cada canal '''
+    return [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(nchannels)]
+
+def whitenoise_blocks(T=None, flow=None, fhigh=None, fslow=None, fshigh=None, nchannels=1, rms=-15.0, 
+                      blocksize=4096, ntaps=1023, seed=None, fs=48000):
+    """
+    Generador de ruido blanco por bloques de blocksize x nchannels (de duracion total T, o infinito si 
+    T es None) con memoria acotada por el tamano del bloque. Si se da flow o fhigh se limita en banda 
+    como whitenoise con un filtro FIR de ntaps coeficientes aplicado con overlap-add.
+    Cada canal usa un generador independiente derivado de seed. El nivel es rms dB (no normaliza picos)
+    """
+    rngs = _channel_rngs(seed,nchannels)
+    scale = np.power(10.0,rms/20.0)
+    if flow is not None or fhigh is not None:
+        freqs = np.linspace(0,fs/2,ntaps+1)
+        freqs[0] = 1e-3
+        gain = _band_gain(freqs,flow,fhigh,fslow,fshigh)
+        gain[-1] = 0.0
+        freqs[0] = 0.0
+        h = signal.firwin2(ntaps,freqs,gain,fs=fs)
+        h /= np.sqrt(np.sum(np.square(h)))
+        tail = np.zeros((ntaps-1,nchannels))
     else:
-        s2 = 1
-    real = s1*s2*np.random.randn(nchannels, freqs.shape[0])
-    imag = s1*s2*np.random.randn(nchannels, freqs.shape[0])
-    if not nsamples & 1:
-        imag[-1] = 0.
-    wnoise = np.array(np.fft.irfft(real + 1j*imag),ndmin=2, dtype='float64').T
-    wnoise /= np.abs(wnoise).max(axis=0)
-    fadeinout(wnoise, fadein=fadein, fadeout=fadeout, fs=fs)
-    wavfile.write(filename + '.wav',fs,wnoise) 
-    return wnoise
+        h = None
+    nsamples = None if T is None else int(T*fs)
+    n = 0
+    while nsamples is None or n < nsamples:
+        nb = blocksize if nsamples is None else min(blocksize,nsamples-n)
+        block = np.stack([rng.standard_normal(nb) for rng in rngs],axis=1)
+        if h is not None:
+            y = oaconvolve(block,h[:,np.newaxis],axes=0)
+            y[:ntaps-1] += tail
+            tail = np.zeros((ntaps-1,nchannels))
+            tail[:len(y)-nb] = y[nb:]
+            block = y[:nb]
+        n += nb
+        yield scale*block
+
+def pinknoise_blocks(T=None, ncols=16, nchannels=1, rms=-15.0, blocksize=4096, seed=None, fs=48000):
+    """
+    Generador de ruido rosa (Voss-McCartney como pinknoise) por bloques de blocksize x nchannels 
+    de duracion total T (infinito si T es None), con canales independientes derivados de seed.
+    El estado de las ncols fuentes pasa de un bloque al siguiente. El nivel es rms dB
+    """
+    rngs = _channel_rngs(seed,nchannels)
+    scale = np.power(10.0,rms/20.0)/np.sqrt(ncols/12.0)
+    state = np.stack([rng.random(ncols) for rng in rngs])
+    nsamples = None if T is None else int(T*fs)
+    n = 0
+    while nsamples is None or n < nsamples:
+        nb = blocksize if nsamples is None else min(blocksize,nsamples-n)
+        block = np.zeros((nb,nchannels))
+        for c, rng in enumerate(rngs):
+            array = np.full((nb+1, ncols), np.nan)
+            array[0, :] = state[c]
+            array[1:, 0] = rng.random(nb)
+            cols = rng.geometric(0.5, nb)
+            cols[cols >= ncols] = 0
+            rows = rng.integers(nb, size=nb)+1
+            array[rows, cols] = rng.random(nb)
+            idx = np.where(~np.isnan(array),np.arange(nb+1)[:,None],0)
+            array = np.take_along_axis(array,np.maximum.accumulate(idx,axis=0),axis=0)
+            state[c] = array[-1]
+            block[:,c] = np.sum(array[1:],axis=1)-0.5*ncols
+        n += nb
+        yield scale*block
+
+def burst_noise_blocks(nburst, dur, gap, type='white', flow=None, fhigh=None, fslow=None, fshigh=None, nchannels=1, 
+                       fadein=None, fadeout=None, rms=-15.0, blocksize=4096, seed=None, fs=48000):
+    """
+    Version por bloques de burst_noise: nburst rafagas de ruido (white o pink) de duracion dur 
+    separadas por gap segundos, con fadein y fadeout de coseno, generadas con memoria acotada
+    """
+    T = nburst*(dur+gap)
+    if type == 'white':
+        blocks = whitenoise_blocks(T, flow=flow, fhigh=fhigh, fslow=fslow, fshigh=fshigh, nchannels=nchannels, 
+                                   rms=rms, blocksize=blocksize, seed=seed, fs=fs)
+    elif type == 'pink':
+        blocks = pinknoise_blocks(T, nchannels=nchannels, rms=rms, blocksize=blocksize, seed=seed, fs=fs)
+    else:
+        raise Exception("Invalid noise type")
+    n = 0
+    for block in blocks:
+        tau = np.mod((n+np.arange(len(block)))/fs,dur+gap) # tiempo dentro de cada rafaga
+        a = (tau < dur).astype(float)
+        if fadein is not None:
+            a = np.where(tau < fadein,(1.0-np.cos(np.pi*tau/fadein))/2.0*a,a)
+        if fadeout is not None:
+            a = np.where((tau > dur-fadeout) & (tau < dur),(1.0+np.cos(np.pi*(tau-dur+fadeout)/fadeout))/2.0,a)
+        n += len(block)
+        yield block*a[:,np.newaxis]
 
 def pinknoise(T, ncols=16, fadein=None, fadeout=None, fs=48000):
     """
@@ -177,4 +446,62 @@ def burst_noise(nburst, dur, gap, type='white', flow=None, fhigh=None, fslow=Non
         raise Exception("Invalid noise type")
     burst(data, nburst=nburst, dur=dur, gap=gap, fadein=fadein, fadeout=fadeout, fs=fs)
     return data
-    
\ No newline at end of file
+    
+def synthetic_irs(nir, dur=1.0, nchan=1, rt=None, rtrange=(0.3,2.0), fmin=62.5, noct=8, bwoct=1, tdir=(0.002,0.01),
+                  nrefl=12, tearly=0.05, late=-20.0, noise=-80.0, seed=None, chunk=64, fs=48000):
+    '''
+    Genera nir respuestas impulso sinteticas de duracion dur y nchan canales con sonido directo (amplitud 1)
+    en un tiempo al azar en el rango tdir, nrefl reflexiones tempranas dispersas en los tearly segundos siguientes, 
+    cola reverberante de ruido con decaimiento exponencial por bandas (mismas fc que make_filterbank con fmin,noct,bwoct)
+    de nivel inicial late dB y piso de ruido de nivel noise dB (ambos respecto al directo)
+    rt: tiempos de reverberacion (escalar, nbands o nir x nbands). Si es None se sortean con rt medio en rtrange y 
+    pendiente espectral al azar. Se generan de a chunk respuestas en forma vectorizada 
+    Devuelve un diccionario con 'ir' (nir x nsamples x nchan float32), 'rt' (nir x nbands, valores verdaderos), 
+    'fc', 'tdir' (nir) y 'fs'
+    '''
+    rng = np.random.default_rng(seed)
+    nbands = (noct-1)*bwoct+1
+    fc = np.array([fmin* 2 ** (n * 1 / bwoct) for n in range(nbands)])
+    if rt is None:
+        rtmid = rng.uniform(rtrange[0],rtrange[1],(nir,1))
+        slope = rng.uniform(0.0,0.4,(nir,1))
+        rt = np.maximum(rtmid*(fc/1000.0)**(-slope),0.1)
+    rt = np.broadcast_to(np.asarray(rt,dtype=float),(nir,nbands)).copy()
+    t0 = rng.uniform(tdir[0],tdir[1],nir)
+    nsamples = int(dur*fs)
+    t = np.arange(nsamples)/fs
+    # pesos complementarios en potencia (coseno en escala logaritmica) para separar la cola en bandas
+    freqs = np.fft.rfftfreq(nsamples,1/fs)
+    x = np.log2(np.maximum(freqs,fmin/4)/fmin)*bwoct
+    x = np.clip(x,0,nbands-1)
+    wband = np.maximum(np.cos(np.pi/2*(x[np.newaxis,:]-np.arange(nbands)[:,np.newaxis])),0.0)
+    wband[np.abs(x[np.newaxis,:]-np.arange(nbands)[:,np.newaxis])>=1] = 0.0
+    listofkeys = ['ir','rt','fc','tdir','fs']
+    out = dict.fromkeys(listofkeys,0)
+    ir = np.zeros((nir,nsamples,nchan),dtype=np.float32)
+    for n1 in range(0,nir,chunk):
+        n2 = min(n1+chunk,nir)
+        tt = np.maximum(t[np.newaxis,:]-t0[n1:n2,np.newaxis],0.0) # tiempo desde el directo
+        onset = (t[np.newaxis,:] >= t0[n1:n2,np.newaxis])[:,:,np.newaxis]
+        N = rfft(rng.standard_normal((n2-n1,nsamples,nchan)),axis=1)
+        tail = np.zeros((n2-n1,nsamples,nchan))
+        for b in range(nbands):
+            env = np.exp(-6.9078*tt/rt[n1:n2,b,np.newaxis])
+            tail += irfft(N*wband[b][np.newaxis,:,np.newaxis],n=nsamples,axis=1)*env[:,:,np.newaxis]
+        y = np.power(10.0,late/20.0)*tail*onset + np.power(10.0,noise/20.0)*rng.standard_normal(tail.shape)
+        # directo y reflexiones tempranas (decaen con el rt medio)
+        ndir = np.round(t0[n1:n2]*fs).astype(int)
+        y[np.arange(n2-n1),ndir,:] += 1.0
+        trefl = rng.uniform(0.001,tearly,(n2-n1,nrefl))
+        nref = np.minimum(ndir[:,np.newaxis]+np.round(trefl*fs).astype(int),nsamples-1)
+        aref = rng.uniform(0.2,0.7,(n2-n1,nrefl))*rng.choice([-1.0,1.0],(n2-n1,nrefl))
+        aref *= np.exp(-6.9078*trefl/np.mean(rt[n1:n2],axis=1,keepdims=True))
+        for c in range(nchan):
+            np.add.at(y[:,:,c],(np.arange(n2-n1)[:,np.newaxis],nref),aref)
+        ir[n1:n2] = y
+    out['ir'] = ir
+    out['rt'] = rt
+    out['fc'] = fc
+    out['tdir'] = t0
+    out['fs'] = fs
+    return out
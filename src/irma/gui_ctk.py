@@ -1,7 +1,7 @@
 import customtkinter as ctk
 import csv
 import sounddevice as sd
-from .generate import sweep
+from .generate import sweep_library
 from .process import ir_list_to_multichannel,make_filterbank,load_filterbank
 from .room import paracoustic
 from .display import ir_plot, pars_compared_axes,irstat_plot,parsdecay_plot,echo_display, spectrum_plot
@@ -58,12 +58,8 @@ class GenerateSweep(ctk.CTkToplevel):
         self.sweep_post = float(self.sweep_post_entry.get())
         self.sweep_rep = int(self.sweep_rep_entry.get())
 
-        srkhz = self.sampling_rate//1000
-        maxrange = self.sweep_fmax//1000
-        self.sweepfile = f"sweep_x{self.sweep_rep}_{srkhz}k_{int(self.sweep_dur)}s_{self.sweep_fmin}_{maxrange}k"
-        print("generating sweep " + self.sweepfile)
-        sweep(T=self.sweep_dur,fs=self.sampling_rate,f1=self.sweep_fmin,f2=self.sweep_fmax,Nrep=self.sweep_rep,
-        filename=self.sweepfile,post=self.sweep_post)
+        self.sweepfile = sweep_library(T=self.sweep_dur,fs=self.sampling_rate,f1=self.sweep_fmin,f2=self.sweep_fmax,
+                                       Nrep=self.sweep_rep,post=self.sweep_post)
         self.parent.sweep_file = self.sweepfile
         self.parent.rewrite_entry(self.parent.sweep_file_entry,[self.sweepfile])
         self.parent.rewrite_textbox(self.parent.status,f"Sweep generated in {self.sweepfile}.wav")
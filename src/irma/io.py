@@ -1,6 +1,14 @@
+import time
+import queue
+import wave
+import threading
 import numpy as np
 import sounddevice as sd
+from scipy import signal
 from scipy.io import wavfile
+from scipy.fft import rfft, irfft
+from .process import load_inverse, inv_sweep_spectrum
+from .room import revtime
 
 def time_rec(filerec,duration,delay=0,chanin=[1],fs=48000,sdevice=None,write_wav=True):
     '''
@@ -26,6 +34,8 @@ def play_rec(fplay,filerec,delay=0,chanout=[1],chanin=[1],revtime=2.0,sdevice=No
     y grabarlo simultaneamente en una cantidad arbitraria de canales de entrada dada por chanin (lista)
     en archivo filerec. Puede cambiarse la cantidad de segundos que graba luego de que se extinguio 
     la senal revtime y cambiar el device si no se usa el default 
+    Si fplay tiene tantos canales como chanout (por ejemplo generate.mesm) cada canal sale por su 
+    salida, sino se reproduce el primer canal por todas
     '''
     #agregar una alerta de clipeo y la opcion de correr dummy
     if sdevice is not None:
@@ -33,17 +43,16 @@ def play_rec(fplay,filerec,delay=0,chanout=[1],chanin=[1],revtime=2.0,sdevice=No
     if type(fplay) is str:
         fs2, data = wavfile.read(fplay + '.wav')
     elif type(fplay) is np.ndarray:
-        if fplay.ndim > 1:
-            data = fplay[:,0]
-        else:    
-            data = fplay
+        data = fplay
         fs2=fs        
     else:
         raise TypeError('Input must be ndarray or filename')     
     sd.default.samplerate = fs2
     nchanout = len(chanout)
-    data = np.append(data,np.zeros(int(revtime*fs))) # extiende data para agregar la reverberacion
-    data = np.repeat(data[:,np.newaxis],nchanout,1) # repite el array 
+    if data.ndim == 1 or data.shape[1] != nchanout:
+        data = data[:,0] if data.ndim > 1 else data
+        data = np.repeat(data[:,np.newaxis],nchanout,1) # repite el array 
+    data = np.vstack((data,np.zeros((int(revtime*fs),nchanout)))) # extiende data para agregar la reverberacion
     # wait delay e imprimir algun algun mensaje
     # loop sobre repeat
     rec = sd.playrec(data, input_mapping=chanin,output_mapping=chanout,dtype='float64') # graba con 64 bits para proceso
@@ -54,6 +63,215 @@ def play_rec(fplay,filerec,delay=0,chanout=[1],chanin=[1],revtime=2.0,sdevice=No
     # fin loop   
     return rec
 
+def play_rec_adaptive(fsweep,filerec,fileout=None,chanout=[1],chanin=[1],loopback=None,snr=50.0,minrep=2,maxrep=20,method='RT20',sdevice=None,write_wav=True,fs=None):
+    '''
+    funcion para reproducir en loop el sweep fsweep (fsweep.wav y su filtro inverso fsweep_inv.npz)
+    por los canales chanout y grabar en chanin. Cada repeticion se deconvoluciona apenas se completa, 
+    se actualiza el promedio y se estima la SNR de la IR promedio con room.revtime sobre la IR 
+    devuelta (medio periodo del sweep, N/2 muestras) cuya segunda mitad (de N/4 a N/2) se usa como 
+    estimacion del ruido. La reproduccion se detiene cuando la SNR de todos los canales (sin el 
+    loopback) alcanza snr (dB), o luego de maxrep repeticiones.
+    La primera repeticion se descarta porque no esta en regimen periodico. Si hay un canal de loopback
+    (indice en chanin) se usa para alinear la IR final y se elimina como en process.ir_extract
+    La frecuencia de sampleo es la del filtro inverso, si se da fs debe coincidir
+    Devuelve la ir promedio (la almacena en fileout si se da), la SNR por canal y las repeticiones usadas
+    '''
+    if sdevice is not None:
+        sd.default.device = sdevice
+    datainv = load_inverse(fsweep)
+    if datainv['type'] != 'sweep':
+        raise ValueError("fsweep must be a sweep")
+    if fs is not None and fs != datainv['fs']:
+        raise ValueError('sampling rate of inverse filter does not match requested sample rate')
+    fs = int(datainv['fs'])
+    invfilt, N = inv_sweep_spectrum(datainv)
+    _, data = wavfile.read(fsweep + '.wav')
+    sweep = data[:N] if data.ndim == 1 else data[:N,0]
+    nchan = len(chanin)
+    out_idx = [c-1 for c in chanout]
+    in_idx = [c-1 for c in chanin]
+    blocks = queue.Queue()
+    stop = threading.Event()
+    pos = [0]
+    def callback(indata, outdata, frames, time, status):
+        outdata.fill(0)
+        if not stop.is_set():
+            outdata[:,out_idx] = sweep[(pos[0]+np.arange(frames)) % N][:,np.newaxis]
+            pos[0] += frames
+        blocks.put(indata[:,in_idx].copy())
+    rec = []
+    pending = np.zeros((0,nchan))
+    nseg = 0
+    nrep = 0
+    ir = np.zeros((N,nchan))
+    m2 = np.zeros((N,nchan))
+    SNR = np.zeros((nchan-(loopback is not None),))
+    with sd.Stream(samplerate=fs,channels=(max(chanin),max(chanout)),dtype='float64',callback=callback):
+        while not stop.is_set():
+            block = blocks.get(timeout=2.0+N/fs)
+            rec.append(block)
+            pending = np.vstack((pending,block))
+            while len(pending) >= N and not stop.is_set():
+                seg = pending[:N]
+                pending = pending[N:]
+                nseg += 1
+                if nseg == 1:
+                    continue
+                ir_rep = irfft(rfft(seg,axis=0)*invfilt[:,np.newaxis],N,axis=0)
+                nrep += 1
+                delta = ir_rep-ir
+                ir += delta/nrep
+                m2 += delta*(ir_rep-ir)
+                if nrep >= minrep:
+                    # revtime sobre la IR de N/2 muestras con tmax N/4: la segunda mitad es el ruido
+                    # canal por canal porque revtime corta en el primer canal con SNR insuficiente para method
+                    SNR = np.array([revtime(ir[:N//2,k],method,fs,tmax=N/(4*fs))[4][0] 
+                                    for k in range(nchan) if k != loopback])
+                    print(f'Repetition {nrep}: SNR = {np.min(SNR):.1f} dB')
+                    if np.min(SNR) >= snr or nrep >= maxrep:
+                        stop.set()
+    print('finished')
+    ir_std = np.sqrt(m2/nrep)
+    if loopback is not None:
+        n0 = np.argmax(ir[:,loopback])
+        ir = np.delete(np.roll(ir,-n0,axis=0),loopback,1)
+        ir_std = np.delete(np.roll(ir_std,-n0,axis=0),loopback,1)
+    ir = ir[:N//2]
+    ir_std = ir_std[:N//2]
+    if write_wav:
+        wavfile.write(filerec + '.wav',fs,np.vstack(rec))
+    if fileout is not None:
+        wavfile.write(fileout + '.wav',fs,ir)
+        np.savez(fileout,ir=ir,ir_std=ir_std,fs=fs,nrep=nrep,SNR=SNR)
+    return ir, SNR, nrep
+
+class TransferAnalyzer:
+    '''
+    Analizador en tiempo real de la transferencia entre un canal de referencia (chanref) y los microfonos
+    de medicion (chanmeas) a partir de cualquier senal de programa (musica, voz) como hace crossspectrum.
+    El callback de audio solo encola los bloques (sin bloquear, si la cola se llena cuenta el bloque en
+    dropped) y un thread los procesa: la primera vez estima el retardo de cada microfono respecto de la
+    referencia (correlacion cruzada con PHAT sobre lagtime segundos, hasta maxlag), luego con ventanas de 
+    nfft muestras y salto hop promedia exponencialmente (constante de tiempo tau) los espectros Sxx, Syy y 
+    Sxy con la referencia compensada en retardo, y rate veces por segundo publica H = Sxy/Sxx y la coherencia
+    en los atributos f, H (nf x nmeas), coherence y lag, y llama a callback(f, H, coherence) si se da.
+    Uso: ta = TransferAnalyzer(1,[2,3]); ta.start(); ... ; ta.stop()  (feed permite procesar bloques sin placa)
+    '''
+    def __init__(self,chanref=1,chanmeas=[2],nfft=8192,hop=None,tau=1.0,rate=4.0,maxlag=0.5,lagtime=2.0,
+                 window='hann',callback=None,sdevice=None,qsize=256,fs=48000):
+        self.chanin = [chanref] + list(chanmeas)
+        self.nmeas = len(chanmeas)
+        self.nfft = nfft
+        self.hop = hop or nfft//2
+        self.alpha = np.exp(-self.hop/(tau*fs))
+        self.period = 1.0/rate
+        self.maxlag = int(maxlag*fs)
+        self.nlag = max(int(lagtime*fs),2*self.maxlag)
+        self.win = signal.get_window(window,nfft)
+        self.callback = callback
+        self.sdevice = sdevice
+        self.fs = fs
+        self.f = np.fft.rfftfreq(nfft,1/fs)
+        self.H = None
+        self.coherence = None
+        self.lag = None
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=qsize)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._buf = np.zeros((0,self.nmeas+1))
+        self._Sxx = np.zeros(len(self.f))
+        self._Syy = np.zeros((len(self.f),self.nmeas))
+        self._Sxy = np.zeros((len(self.f),self.nmeas),dtype=complex)
+        self._nframes = 0
+        self._tpub = time.monotonic()
+        self._stream = None
+        self._thread = None
+
+    def _audio_callback(self, indata, frames, time_info, status):
+        try:
+            self._queue.put_nowait(indata[:,[c-1 for c in self.chanin]].copy())
+        except queue.Full:
+            self.dropped += 1
+
+    def _worker(self):
+        while not self._stop.is_set():
+            try:
+                block = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.feed(block)
+
+    def start(self):
+        ''' abre el stream de entrada y arranca el thread de procesamiento '''
+        if self.sdevice is not None:
+            sd.default.device = self.sdevice
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._worker,daemon=True)
+        self._thread.start()
+        self._stream = sd.InputStream(samplerate=self.fs,channels=max(self.chanin),dtype='float32',
+                                      blocksize=self.hop,callback=self._audio_callback)
+        self._stream.start()
+
+    def stop(self):
+        ''' detiene el stream y el thread de procesamiento '''
+        if self._stream is not None:
+            self._stream.stop()
+            self._stream.close()
+            self._stream = None
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def estimate_lag(self, data):
+        '''
+        retardo (en muestras, entre 0 y maxlag) de cada microfono respecto de la referencia 
+        por correlacion cruzada con ponderacion PHAT de data (nsamples x 1+nmeas)
+        '''
+        n = len(data)
+        X = rfft(data,2*n,axis=0)
+        G = np.conj(X[:,:1])*X[:,1:]
+        R = irfft(G/np.maximum(np.abs(G),np.finfo(float).tiny),2*n,axis=0)
+        return np.argmax(np.abs(R[:self.maxlag+1]),axis=0)
+
+    def feed(self, block):
+        '''
+        agrega un bloque (nsamples x 1+nmeas, referencia primero) y procesa todas las ventanas completas
+        '''
+        self._buf = np.vstack((self._buf,block))
+        if self.lag is None:
+            if len(self._buf) < self.nlag:
+                return
+            self.lag = self.estimate_lag(self._buf[:self.nlag])
+            print('Estimated delay (ms): ' + str(np.round(1000*self.lag/self.fs,2)))
+        lagmax = np.max(self.lag)
+        n = 0
+        while n + lagmax + self.nfft <= len(self._buf):
+            ref = self._buf[n:n+self.nfft,0]
+            meas = np.stack([self._buf[n+l:n+l+self.nfft,c+1] for c, l in enumerate(self.lag)],axis=1)
+            X = rfft(self.win*ref)
+            Y = rfft(self.win[:,np.newaxis]*meas,axis=0)
+            a = self.alpha if self._nframes > 0 else 0.0
+            self._Sxx = a*self._Sxx + (1-a)*np.abs(X)**2
+            self._Syy = a*self._Syy + (1-a)*np.abs(Y)**2
+            self._Sxy = a*self._Sxy + (1-a)*np.conj(X)[:,np.newaxis]*Y
+            self._nframes += 1
+            n += self.hop
+        self._buf = self._buf[n:]
+        if self._nframes > 0 and time.monotonic() - self._tpub >= self.period:
+            self.publish()
+
+    def publish(self):
+        ''' calcula H y coherencia de los espectros promediados y llama a callback '''
+        eps = np.finfo(float).tiny
+        with self._lock:
+            self.H = self._Sxy/np.maximum(self._Sxx,eps)[:,np.newaxis]
+            self.coherence = np.abs(self._Sxy)**2/np.maximum(self._Sxx[:,np.newaxis]*self._Syy,eps)
+        self._tpub = time.monotonic()
+        if self.callback is not None:
+            self.callback(self.f,self.H,self.coherence)
+
 def play(fplay,chanout=[1],sdevice=None,normalized=False,fs=48000,block=False):
     '''
     funcion para reproducir el array fplay (solo el primer canal) o archivo mono fplay.wav a traves de los canales de salida chanout (lista)
@@ -80,13 +298,56 @@ def play(fplay,chanout=[1],sdevice=None,normalized=False,fs=48000,block=False):
         sd.play(data, mapping=mapping,blocking=block)     
     return
 
-def load_pcm(file,nchan,nbytes=4):
+def play_blocks(blocks,chanout=[1],sdevice=None,fs=48000):
+    '''
+    reproduce los bloques (nsamples x nchan) que entrega el generador blocks (por ejemplo 
+    generate.whitenoise_blocks) por los canales chanout sin cargar toda la senal en memoria.
+    Si los bloques tienen un solo canal se repite por todas las salidas
+    '''
+    if sdevice is not None:
+        sd.default.device = sdevice
+    out_idx = [c-1 for c in chanout]
+    with sd.OutputStream(samplerate=fs,channels=max(chanout),dtype='float32') as stream:
+        for block in blocks:
+            if block.ndim == 1:
+                block = block[:,np.newaxis]
+            out = np.zeros((len(block),max(chanout)),dtype='float32')
+            out[:,out_idx] = block
+            stream.write(out)
+    return
+
+def write_wav_blocks(filename,blocks,fs=48000):
+    '''
+    escribe los bloques (nsamples x nchan) del generador blocks en filename.wav (PCM de 32 bits)
+    a medida que se generan, con memoria acotada por el tamano del bloque. Devuelve las muestras escritas
+    '''
+    nsamples = 0
+    with wave.open(filename + '.wav','wb') as wav:
+        for block in blocks:
+            if block.ndim == 1:
+                block = block[:,np.newaxis]
+            if nsamples == 0:
+                wav.setnchannels(block.shape[1])
+                wav.setsampwidth(4)
+                wav.setframerate(fs)
+            wav.writeframes((np.clip(block,-1.0,1.0)*(2**31-1)).astype('<i4').tobytes())
+            nsamples += len(block)
+    return nsamples
+
+def load_pcm(file,nchan,nbytes=4,mmap=False):
     """
     Function to load a raw PCM audio file with nchan channels and nbytes little endian
+    If mmap is True returns the integer memmap (nsamples x nchan) without loading or scaling,
+    to be read by blocks (for example by process.ir_extract_stream)
     """
     nmax = 2**(nbytes*8-1)
     data=np.memmap(file, dtype='u1', mode='r')
     nsamples=data.shape[0]//(nchan*nbytes)
+    if mmap:
+        if nbytes not in (4,2,1):
+            raise Exception("Only 4,2 or 1 bytes allowed")
+        dtype = {4:'<i4',2:'<i2',1:'i1'}[nbytes]
+        return np.reshape(data[:nsamples*nchan*nbytes].view(dtype),(nsamples,nchan))
     if nbytes==4:
         realdata=np.reshape(data.view(np.int32)/nmax,(nsamples,nchan)).astype('float64')
     elif nbytes==2:
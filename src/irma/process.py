@@ -1,12 +1,14 @@
+import os
 import numpy as np
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from scipy import signal
 from scipy.io import wavfile
-from scipy.interpolate import interp1d
-from scipy.signal import convolve
-from scipy.fft import next_fast_len, rfft, irfft, fft, ifft
-from numpy.fft.helper import fftfreq
+from scipy.signal import convolve, oaconvolve, find_peaks
+from scipy.fft import next_fast_len, rfft, irfft
 
-def ir_extract(rec,fileinv,fileout='ir_out',loopback=None,dur=None,fs=48000):
+def ir_extract(rec,fileinv,fileout='ir_out',loopback=None,dur=None,fs=48000,blocksize=None,average='mean',
+               trim=0.1,threshold=3.5):
     '''
     extrae la respuesta impulso a partir de la grabacion del sweep (rec) y el filtro inverso 
     almacenado en fileinv (archivo npy), ambos parametros obligatorios.
@@ -14,27 +16,42 @@ def ir_extract(rec,fileinv,fileout='ir_out',loopback=None,dur=None,fs=48000):
     Si hay un canal de loopback lo usa para alinear y hay que proporcionar el numero de canal
     devuelve la ri obtenida (puede ser mas de un canal) y la almacena en fileout 
     (si la entrada fue un archivo) con una duracion dur (la ir completa por defecto)
+    Si se da blocksize la extraccion se hace por bloques (ver ir_extract_stream)
+    average es el metodo para promediar las repeticiones, con trim y threshold (ver ir_average)
     '''
     # rec puede ser un nombre de un archivo o un prefijo
-    
+    if blocksize is not None:
+        if average != 'mean':
+            raise ValueError("block-streaming extraction only supports average='mean'")
+        return ir_extract_stream(rec,fileinv,fileout,loopback=loopback,dur=dur,fs=fs,blocksize=blocksize)
     if type(rec) is str:
         fs, data = wavfile.read(rec + '.wav')
-    elif type(rec) is np.ndarray:
+    elif isinstance(rec,np.ndarray):
         data = rec
     else:
         raise TypeError('First argument must be the array given by play_rec or a file name')
     if data.ndim == 1:
         data = data[:,np.newaxis] # el array debe ser 2D    
-    datainv = np.load(fileinv + '_inv.npz')
+    scale = _pcm_scale(rec,data)
+    if scale != 1.0:
+        data = data*scale
+    datainv = load_inverse(fileinv)
     _, nchan = np.shape(data)
     if fs != datainv['fs']:
         raise ValueError('sampling rate of inverse filter does not match file sample rate')    
+    if datainv['type'] == 'mesm':
+        return ir_extract_mesm(data,fileinv,fileout,loopback=loopback,dur=dur,fs=fs,average=average,
+                               trim=trim,threshold=threshold)
     if datainv['type'] == 'sweep':  
         ir_stack=ir_sweep(data,datainv,nchan)
     elif datainv['type'] == 'golay':
         ir_stack=ir_golay(data,datainv,nchan)
+    elif datainv['type'] == 'mls':
+        ir_stack=ir_mls(data,datainv,nchan)
+    elif datainv['type'] == 'multisine':
+        ir_stack=ir_multisine(data,datainv,nchan)
     else:
-        raise ValueError("inv_type must be 'sweep' or 'golay'") 
+        raise ValueError("inv_type must be 'sweep', 'mesm', 'golay', 'mls' or 'multisine'") 
     # ir dimensions: Nrep, nsamples, nchan
     Nrep,N,_ = ir_stack.shape
     if loopback is not None:
@@ -46,12 +63,9 @@ def ir_extract(rec,fileinv,fileout='ir_out',loopback=None,dur=None,fs=48000):
         ndur = np.min(int(N/2)-n0)
     else:
         ndur = int(np.round(dur*fs))
-    ir_align = np.zeros((Nrep,ndur,nchan))
-    for n in range(nchan):
-        for m in range(Nrep):
-            ir_align[m,:,n] = ir_stack[m,n0[m]:n0[m]+ndur,n]
-    ir = np.mean(ir_align,axis=0)
-    ir_std = np.std(ir_align,axis=0)
+    idx = (n0[:,np.newaxis]+np.arange(ndur)) % N
+    ir_align = np.take_along_axis(ir_stack,idx[:,:,np.newaxis],axis=1)
+    ir, ir_std = ir_average(ir_align,method=average,trim=trim,threshold=threshold)
     if loopback is not None:
         ir = np.delete(ir ,loopback,1)
         ir_std = np.delete(ir_std ,loopback,1)  
@@ -62,14 +76,370 @@ def ir_extract(rec,fileinv,fileout='ir_out',loopback=None,dur=None,fs=48000):
         np.save(fileout,ir)    
     return ir
 
-def ir_sweep(data,datainv,nchan):
+def ir_extract_mesm(rec,fileinv,fileout='ir_out',loopback=None,dur=None,fs=48000,average='mean',
+                    trim=0.1,threshold=3.5):
+    '''
+    extrae las IR de todos los parlantes de una medicion con multiples sweeps (generate.mesm)
+    a partir de la grabacion rec (array nsamp x nchan o nombre del archivo wav) con una sola 
+    deconvolucion. Devuelve un array nspk x nsamples x nchan (nsamples es el retardo entre parlantes,
+    o dur segundos si se da, que no puede superarlo) y guarda la IR de cada parlante en 
+    fileout_S1.wav, fileout_S2.wav, ... y todas en fileout.npz
+    Si hay un canal de loopback (indice del canal, conectado a la salida de cualquiera de los parlantes)
+    su pico da la latencia (menor que el retardo entre parlantes) con la que se alinean todas las IR, 
+    y se elimina como en ir_extract
+    '''
+    if type(rec) is str:
+        fs, data = wavfile.read(rec + '.wav')
+    elif type(rec) is np.ndarray:
+        data = rec
+    else:
+        raise TypeError('First argument must be an array or a file name')
+    if data.ndim == 1:
+        data = data[:,np.newaxis] # el array debe ser 2D
+    datainv = load_inverse(fileinv)
+    _, nchan = np.shape(data)
+    if fs != datainv['fs']:
+        raise ValueError('sampling rate of inverse filter does not match file sample rate')
+    if datainv['type'] != 'mesm':
+        raise ValueError("inverse filter must be of type 'mesm'")
+    nspk = int(datainv['nspk'])
+    ntau = int(datainv['ntau'])
+    ndur = ntau if dur is None else int(np.round(dur*fs))
+    if ndur > ntau:
+        raise ValueError('dur cannot exceed the delay between speakers of the MESM signal')
+    ir_stack = ir_sweep(data,datainv,nchan)
+    Nrep, N, _ = ir_stack.shape
+    if loopback is not None:
+        n0 = np.argmax(ir_stack[:,:,loopback],axis=1) % ntau
+    else:
+        n0 = np.zeros((Nrep,),dtype=int)
+    # la IR del parlante n empieza en n*ntau (mas la latencia n0)
+    idx = (n0[:,np.newaxis,np.newaxis]+ntau*np.arange(nspk)[:,np.newaxis]+np.arange(ndur)) % N
+    ir_stack = ir_stack[np.arange(Nrep)[:,np.newaxis,np.newaxis],idx,:] # Nrep x nspk x ndur x nchan
+    ir, ir_std = ir_average(ir_stack,method=average,trim=trim,threshold=threshold)
+    if loopback is not None:
+        ir = np.delete(ir,loopback,2)
+        ir_std = np.delete(ir_std,loopback,2)
+    for n in range(nspk):
+        wavfile.write(fileout + '_S' + str(n+1) + '.wav',fs,ir[n])
+    np.savez(fileout,ir=ir,ir_std=ir_std,fs=fs,nspk=nspk)
+    return ir
+
+def ir_harmonics(rec,fileinv,K=5,dur=None,pre=0.005,fs=48000,average='mean',trim=0.1,threshold=3.5):
+    '''
+    Separa la IR lineal y las IR de distorsion armonica de orden 2 a K de una misma deconvolucion
+    del sweep exponencial (la IR de orden k queda antes de la lineal, a la diferencia entre los
+    instantes en que el sweep pasa por k f y por f), para todas las repeticiones y canales a la vez.
+    rec es el array nsamp x nchan o el nombre del archivo wav, fileinv el filtro inverso que debe 
+    tener la ley tiempo-frecuencia gdlaw (sweeps generados con generate.sweep; en archivos viejos 
+    se aproxima con tsweep*ln(k)/ln(f2/f1)). Las ventanas empiezan pre segundos antes de cada IR 
+    y duran dur segundos, o la maxima separacion entre ordenes si es menor.
+    Devuelve un diccionario hd con keys
+    hd['ir'] IR de orden 1 (lineal) a K, array K x nsamples x nchan
+    hd['f'] frecuencias (de la excitacion)
+    hd['HD'] distorsion de orden 2 a K en dB respecto de la lineal |H_k(k f)|/|H_1(f)|, K-1 x nf x nchan
+    hd['THD'] distorsion armonica total en porcentaje, nf x nchan (nan donde 2f supera fs/2)
+    '''
+    if type(rec) is str:
+        fs, data = wavfile.read(rec + '.wav')
+    elif type(rec) is np.ndarray:
+        data = rec
+    else:
+        raise TypeError('First argument must be an array or a file name')
+    if data.ndim == 1:
+        data = data[:,np.newaxis] # el array debe ser 2D
+    datainv = load_inverse(fileinv)
+    _, nchan = np.shape(data)
+    if fs != datainv['fs']:
+        raise ValueError('sampling rate of inverse filter does not match file sample rate')
+    if datainv['type'] != 'sweep' or 'tsweep' not in datainv:
+        raise ValueError('inverse filter must be a sweep with f1, f2 and tsweep stored')
+    if K < 2:
+        raise ValueError('K must be at least 2 (order 1 is the linear IR)')
+    ir_stack = ir_sweep(data,datainv,nchan)
+    N = ir_stack.shape[1]
+    f1, f2 = float(datainv['f1']), float(datainv['f2'])
+    if 'gdlaw' in datainv:
+        # retardo de cada orden: mediana sobre la banda de t(k f) - t(f) segun la ley del sweep
+        fgd, tgd = datainv['gdlaw']
+        dn = np.zeros(K,dtype=int)
+        for k in range(2,K+1):
+            f = np.geomspace(f1,max(f2/k,f1),200)
+            dn[k-1] = int(np.round(np.median(np.interp(k*f,fgd,tgd)-np.interp(f,fgd,tgd))*fs))
+    else:
+        rate = datainv['tsweep']/np.log(f2/f1)
+        dn = np.round(rate*np.log(np.arange(1,K+1))*fs).astype(int)
+    npre = int(np.round(pre*fs))
+    nwin = np.min(np.diff(dn))
+    if dur is not None:
+        nwin = min(nwin,int(np.round(dur*fs)))
+    idx = (-dn[:,np.newaxis]-npre+np.arange(nwin)) % N
+    ir, _ = ir_average(ir_stack[:,idx,:],method=average,trim=trim,threshold=threshold) # K x nwin x nchan
+    H = np.abs(rfft(ir,axis=1))
+    nf = H.shape[1]
+    HD = np.full((K-1,nf,nchan),np.nan)
+    for k in range(2,K+1):
+        nk = (nf-1)//k+1
+        HD[k-2,:nk] = H[k-1,::k][:nk]/(H[0,:nk]+np.finfo(float).eps)
+    THD = 100*np.sqrt(np.nansum(np.square(HD),axis=0))
+    THD[np.isnan(HD[0])] = np.nan
+    listofkeys = ['ir','f','HD','THD']
+    hd = dict.fromkeys(listofkeys,0 )
+    hd['ir'] = ir
+    hd['f'] = np.arange(nf)*fs/nwin
+    hd['HD'] = 20*np.log10(HD)
+    hd['THD'] = THD
+    return hd
+
+def ir_extract_batch(recs,fileinv,fileouts,workers=None,backend='process',progress=None,**kwargs):
+    '''
+    extrae las IR de una lista de grabaciones recs (arrays o nombres de archivo wav) con el mismo 
+    filtro inverso fileinv y las almacena en fileouts (lista de la misma longitud que recs).
+    Usa un pool de procesos (backend='process') o de threads (backend='thread') con workers 
+    trabajadores (None usa todos los nucleos, 1 lo hace en serie en este proceso).
+    kwargs se pasan a ir_extract. progress(ndone,ntotal,rec,error) se llama al terminar cada 
+    grabacion (por defecto imprime el avance). 
+    Devuelve un diccionario con las ir y otro con los errores, ambos indexados por posicion en recs
+    '''
+    if len(recs) != len(fileouts):
+        raise ValueError('recs and fileouts must have the same length')
+    if progress is None:
+        progress = _print_progress
+    names = [rec if type(rec) is str else str(n) for n, rec in enumerate(recs)]
+    irs = {}
+    errors = {}
+    if workers == 1:
+        for n, (rec,fileout) in enumerate(zip(recs,fileouts)):
+            try:
+                irs[n] = ir_extract(rec,fileinv,fileout,**kwargs)
+            except Exception as e:
+                errors[n] = e
+            progress(n+1,len(recs),names[n],errors.get(n))
+        return irs, errors
+    if backend == 'process':
+        executor = ProcessPoolExecutor(max_workers=workers)
+    elif backend == 'thread':
+        executor = ThreadPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError("backend must be 'process' or 'thread'")
+    with executor:
+        futures = {executor.submit(ir_extract,rec,fileinv,fileout,**kwargs): n for n, (rec,fileout) in enumerate(zip(recs,fileouts))}
+        for ndone, future in enumerate(as_completed(futures)):
+            n = futures[future]
+            try:
+                irs[n] = future.result()
+            except Exception as e:
+                errors[n] = e
+            progress(ndone+1,len(recs),names[n],errors.get(n))
+    return irs, errors
+
+def _print_progress(ndone,ntotal,name,error):
+    if error is None:
+        print(f"[{ndone}/{ntotal}] Extracted ---> {name}")
+    else:
+        print(f"[{ndone}/{ntotal}] ERROR in {name}: {error}")
+
+def ir_extract_stream(rec,fileinv,fileout='ir_out',loopback=None,dur=None,fs=48000,blocksize=65536):
+    '''
+    Block-streaming version of ir_extract for sweep recordings that do not fit in memory.
+    rec can be the name of a wav file (read memory-mapped) or an array / memmap of nsamp x nchan
+    (for example the one returned by io.load_pcm with mmap=True).
+    The recording is read in blocks of blocksize samples and convolved with the inverse filter 
+    using uniformly partitioned overlap-save. Each repetition is aligned and accumulated as soon 
+    as it is complete, so peak memory depends on the sweep length, nchan and blocksize but not on 
+    the length of the recording or the number of repetitions. The ir_stack is not stored.
+    Each repetition is deconvolved assuming steady-state periodic excitation (the last one is
+    closed on itself), which gives the same result as ir_extract for periodic sweeps.
+    '''
+    if type(rec) is str:
+        fs, data = wavfile.read(rec + '.wav',mmap=True)
+    elif isinstance(rec,np.ndarray):
+        data = rec
+    else:
+        raise TypeError('First argument must be an array (or memmap) or a file name')
+    if data.ndim == 1:
+        data = data[:,np.newaxis] # el array debe ser 2D
+    scale = _pcm_scale(rec,data)
+    datainv = load_inverse(fileinv)
+    _, nchan = np.shape(data)
+    if fs != datainv['fs']:
+        raise ValueError('sampling rate of inverse filter does not match file sample rate')
+    if datainv['type'] != 'sweep':
+        raise ValueError("streaming extraction is only available for type 'sweep'")
+    invfilt, N = inv_sweep_spectrum(datainv)
+    h = irfft(invfilt,N)
+    Nrep = int(datainv['Nrep'])
+    nmax = N//2 if dur is None else min(int(np.round(dur*fs)),N)
+    nwin = N if loopback is not None else nmax # samples of each repetition that are kept
+    # particiones del filtro inverso
+    B = blocksize
+    P = int(np.ceil(N/B))
+    Hp = rfft(np.reshape(np.pad(h,(0,P*B-N)),(P,B)),2*B,axis=1)[:,:,np.newaxis]
+    fdl = np.zeros((P,B+1,nchan),dtype=complex) # frequency domain delay line
+    prev = np.zeros((B,nchan))
+    win = np.zeros((nwin,nchan))
+    ir_sum = np.zeros((nmax,nchan))
+    ir_sq = np.zeros((nmax,nchan))
+    ndur = nmax
+    # la repeticion m queda en las muestras (m+1)N ... (m+1)N+nwin de la convolucion lineal
+    nblocks = int(np.ceil((Nrep*N+nwin)/B))
+    for k in range(nblocks):
+        n1 = k*B
+        n2 = n1+B
+        cur = _read_block(data,n1,n2,Nrep*N,N,scale)
+        fdl[k%P] = rfft(np.vstack((prev,cur)),axis=0)
+        prev = cur
+        reps = [m for m in range(max(n1//N-1,0),min(n2//N,Nrep)) if (m+1)*N < n2 and (m+1)*N+nwin > n1]
+        if not reps:
+            continue
+        Y = np.zeros((B+1,nchan),dtype=complex)
+        for p in range(min(P,k+1)):
+            Y += Hp[p]*fdl[(k-p)%P]
+        y = irfft(Y,2*B,axis=0)[B:]
+        for m in reps:
+            w1 = (m+1)*N
+            a = max(n1,w1)
+            b = min(n2,w1+nwin)
+            win[a-w1:b-w1] = y[a-n1:b-n1]
+            if b == w1+nwin:
+                if loopback is not None:
+                    n0 = np.argmax(win[:,loopback])
+                else:
+                    n0 = 0
+                if dur is None:
+                    ndur = min(ndur,N//2-n0)
+                aligned = np.take(win,np.arange(n0,n0+nmax),axis=0,mode='wrap')
+                ir_sum += aligned
+                ir_sq += aligned**2
+    ir = ir_sum[:ndur]/Nrep
+    ir_std = np.sqrt(np.maximum(ir_sq[:ndur]/Nrep-ir**2,0))
+    if loopback is not None:
+        ir = np.delete(ir ,loopback,1)
+        ir_std = np.delete(ir_std ,loopback,1)
+    wavfile.write(fileout + '.wav',fs,ir)
+    if Nrep>1:
+        np.savez(fileout,ir=ir,ir_std=ir_std,fs=fs,loopback=loopback)
+    else:
+        np.save(fileout,ir)
+    return ir
+
+def ir_extract_continuous(rec,fileinv,fileout='ir_out',dur=None,pre=0.01,threshold=0.3,chan=None,fs=48000):
+    '''
+    Extracts one IR for every occurrence of the sweep stored in fileinv inside a continuous
+    recording rec (array nsamp x nchan or wav file name, for example from io.time_rec while an
+    external player loops the sweep). The whole recording is convolved once with the inverse 
+    filter (all channels at the same time) and every sweep is detected as a peak of the result 
+    in channel chan (sum of all channels if None) above threshold times the maximum, with peaks 
+    at least half a sweep apart.
+    Returns ir_stack (nsweeps x nsamples x nchan), where each IR starts pre seconds before its 
+    peak and lasts dur seconds (half the sweep length by default), and onsets, the sample at 
+    which each sweep starts in rec (including the acoustic delay). Both are stored in fileout.npz
+    '''
+    if type(rec) is str:
+        fs, data = wavfile.read(rec + '.wav')
+    elif type(rec) is np.ndarray:
+        data = rec
+    else:
+        raise TypeError('First argument must be an array or a file name')
+    if data.ndim == 1:
+        data = data[:,np.newaxis] # el array debe ser 2D
+    datainv = load_inverse(fileinv)
+    if fs != datainv['fs']:
+        raise ValueError('sampling rate of inverse filter does not match file sample rate')
+    if datainv['type'] != 'sweep':
+        raise ValueError("continuous extraction is only available for type 'sweep'")
+    invfilt, N = inv_sweep_spectrum(datainv)
+    h = irfft(invfilt,N)
+    y = oaconvolve(data,h[:,np.newaxis],axes=0) # la IR de un sweep que empieza en n0 esta en n0+N
+    if chan is None:
+        env = np.sum(np.abs(y),axis=1)
+    else:
+        env = np.abs(y[:,chan])
+    npre = int(np.round(pre*fs))
+    ndur = N//2 if dur is None else int(np.round(dur*fs))
+    peaks, _ = find_peaks(env,height=threshold*np.max(env),distance=N//2)
+    peaks = peaks[(peaks>=npre) & (peaks-npre+ndur<=len(y))]
+    idx = peaks[:,np.newaxis]-npre+np.arange(ndur)
+    ir_stack = y[idx]
+    onsets = peaks-N
+    print(f'{len(peaks)} sweeps detected')
+    np.savez(fileout,ir_stack=ir_stack,onsets=onsets,fs=fs,pre=pre)
+    return ir_stack, onsets
+
+def _pcm_scale(rec,data):
+    '''
+    scale factor applied to the recording by ir_extract and ir_extract_stream alike: integer
+    memmaps (raw PCM from io.load_pcm with mmap=True) are taken to +-1 as load_pcm does without
+    mmap, wav files and arrays are used as they are
+    '''
+    if type(rec) is not str and isinstance(data,np.memmap) and np.issubdtype(data.dtype,np.integer):
+        return 2.0**-(8*data.dtype.itemsize-1)
+    return 1.0
+
+def _read_block(data,n1,n2,nper,N,scale=1.0):
+    '''
+    reads samples n1:n2 of data as float64 times scale. Positions beyond nper are taken one 
+    period N back and positions beyond the end of data are zeros
+    '''
+    nsamples, nchan = data.shape
+    block = np.zeros((n2-n1,nchan))
+    for a, b, offset in ((n1,min(n2,nper),0),(max(n1,nper),n2,N)):
+        a2 = a-offset
+        b2 = min(b-offset,nsamples)
+        if b2 > a2:
+            block[a-n1:a-n1+b2-a2] = data[a2:b2]
+    if scale != 1.0:
+        block *= scale
+    return block
+
+def load_inverse(fileinv):
+    '''
+    loads the inverse filter fileinv_inv.npz through an in-process LRU cache keyed by 
+    path and modification time, so repeated extractions with the same excitation do not
+    read and decompress the file again. Each call gets its own dict (keys can be added or 
+    removed without touching the cache) but the arrays are shared and read-only
+    '''
+    fname = os.path.abspath(fileinv + '_inv.npz')
+    st = os.stat(fname)
+    return dict(_load_inverse_cached(fname,st.st_mtime_ns,st.st_size))
+
+@lru_cache(maxsize=8)
+def _load_inverse_cached(fname,mtime,size):
+    with np.load(fname) as npz:
+        datainv = {key: npz[key] for key in npz.files}
+    if 'invsweepfft' in datainv:
+        # old two-sided files are kept as one-sided spectrum ready for ir_sweep
+        invsweepfft, N = inv_sweep_spectrum(datainv)
+        datainv['invsweeprfft'] = np.ascontiguousarray(invsweepfft)
+        datainv['nfft'] = np.array(N)
+        del datainv['invsweepfft']
+    for value in datainv.values():
+        value.flags.writeable = False
+    return datainv
+
+def clear_inverse_cache():
+    ''' empties the cache of inverse filters used by load_inverse '''
+    _load_inverse_cached.cache_clear()
+
+def inv_sweep_spectrum(datainv):
+    '''
+    returns the one-sided spectrum of the inverse filter and its FFT length N
+    works with both the one-sided (invsweeprfft) and the old two-sided (invsweepfft) files
+    '''
+    if 'invsweeprfft' in datainv:
+        return datainv['invsweeprfft'], int(datainv['nfft'])
     invsweepfft = datainv['invsweepfft']
     N = invsweepfft.shape[0]
+    return invsweepfft[:N//2+1], N
+
+def ir_sweep(data,datainv,nchan):
+    invsweepfft, N = inv_sweep_spectrum(datainv)
     Nrep = datainv['Nrep']
     invfilt =  invsweepfft[np.newaxis,:,np.newaxis]
     data_stack = np.reshape(data[:N*Nrep,:],(Nrep,N,nchan))
-    data_fft=fft(data_stack,N,axis=1)
-    ir_stack =  np.real(ifft(data_fft*invfilt,axis=1))
+    data_fft = rfft(data_stack,N,axis=1)
+    data_fft *= invfilt
+    ir_stack = irfft(data_fft,N,axis=1)
     return ir_stack
 
 def ir_golay(data,datainv,nchan):
@@ -87,6 +457,97 @@ def ir_golay(data,datainv,nchan):
     ir_stack = aa+bb
     return ir_stack
 
+def ir_mls(data,datainv,nchan):
+    '''
+    deconvolucion de una MLS periodica con la transformada rapida de Hadamard (Borish y Angell)
+    para todas las repeticiones y canales a la vez. Descarta el primer periodo
+    '''
+    perm_in = datainv['perm_in']
+    perm_out = datainv['perm_out']
+    L = len(perm_in)
+    Nrep = int(datainv['Nrep'])
+    rc_stack = np.reshape(data[L:L*(Nrep+1)],(Nrep,L,nchan))
+    yh = np.zeros((Nrep,L+1,nchan))
+    yh[:,perm_in,:] = rc_stack
+    yh = fwht(yh,axis=1)
+    ir_stack = (yh[:,perm_out,:]-np.sum(rc_stack,axis=1,keepdims=True))/(L+1)
+    return ir_stack
+
+def ir_multisine(data,datainv,nchan):
+    '''
+    IR de cada periodo de un multiseno (generate.multisine) a partir de la transferencia en las 
+    lineas excitadas (rfft por periodo, sin convolucion), interpolada linealmente en las frecuencias 
+    no excitadas de la banda y nula fuera de ella. Descarta el primer periodo
+    Solo para grillas densas ('lin' u 'odd'): en la grilla 'log' la fase gira varios radianes entre
+    lineas y la interpolacion no sirve, la transferencia en las lineas se obtiene con transfer_multisine
+    '''
+    P = int(datainv['nfft'])
+    Nrep = int(datainv['Nrep'])
+    bins = datainv['bins']
+    if len(bins) > 1 and np.max(np.diff(bins)) > 2:
+        raise ValueError("IR extraction needs a 'lin' or 'odd' multisine grid, use transfer_multisine for 'log' grids")
+    rc_stack = np.reshape(data[P:P*(Nrep+1)],(Nrep,P,nchan))
+    H = rfft(rc_stack,axis=1)[:,bins,:]/datainv['Xref'][np.newaxis,:,np.newaxis]
+    Hfull = np.zeros((Nrep,P//2+1,nchan),dtype=complex)
+    if len(bins) > 1:
+        kfull = np.arange(bins[0],bins[-1]+1)
+        n1 = np.clip(np.searchsorted(bins,kfull,side='right')-1,0,len(bins)-2)
+        w = ((kfull-bins[n1])/(bins[n1+1]-bins[n1]))[np.newaxis,:,np.newaxis]
+        Hfull[:,kfull,:] = (1-w)*H[:,n1,:]+w*H[:,n1+1,:]
+    else:
+        Hfull[:,bins,:] = H
+    return irfft(Hfull,P,axis=1)
+
+def transfer_multisine(rec,fileinv,fs=48000):
+    '''
+    Transferencia en las lineas excitadas de un multiseno promediando la rfft de cada periodo
+    (sin el primero). rec es el array nsamp x nchan o el nombre del archivo wav.
+    Devuelve un diccionario tf con keys 'f' (frecuencias excitadas), 'H' (nf x nchan) 
+    y 'Hstd' (desvio de |H| entre periodos)
+    '''
+    if type(rec) is str:
+        fs, data = wavfile.read(rec + '.wav')
+    elif type(rec) is np.ndarray:
+        data = rec
+    else:
+        raise TypeError('First argument must be an array or a file name')
+    if data.ndim == 1:
+        data = data[:,np.newaxis] # el array debe ser 2D
+    datainv = load_inverse(fileinv)
+    _, nchan = np.shape(data)
+    if fs != datainv['fs']:
+        raise ValueError('sampling rate of inverse filter does not match file sample rate')
+    if datainv['type'] != 'multisine':
+        raise ValueError("inverse file must be of type 'multisine'")
+    P = int(datainv['nfft'])
+    Nrep = int(datainv['Nrep'])
+    bins = datainv['bins']
+    rc_stack = np.reshape(data[P:P*(Nrep+1)],(Nrep,P,nchan))
+    H = rfft(rc_stack,axis=1)[:,bins,:]/datainv['Xref'][np.newaxis,:,np.newaxis]
+    listofkeys = ['f','H','Hstd']
+    tf = dict.fromkeys(listofkeys,0 )
+    tf['f'] = bins*fs/P
+    tf['H'] = np.mean(H,axis=0)
+    tf['Hstd'] = np.std(np.abs(H),axis=0)
+    return tf
+
+def fwht(x,axis=0):
+    '''
+    fast Walsh-Hadamard transform (natural order, sin normalizar) de x a lo largo de axis, 
+    cuya longitud debe ser potencia de 2
+    '''
+    x = np.moveaxis(np.array(x,dtype=float),axis,0)
+    n = x.shape[0]
+    if n & (n-1):
+        raise ValueError('length along axis must be a power of 2')
+    rest = x.shape[1:]
+    h = 1
+    while h < n:
+        x = np.reshape(x,(n//(2*h),2,h)+rest)
+        x = np.stack((x[:,0]+x[:,1],x[:,0]-x[:,1]),axis=1)
+        h *= 2
+    return np.moveaxis(np.reshape(x,(n,)+rest),0,axis)
+
 def ir_list_to_multichannel(ir_list,nsamples=None,chan=0):
     """
     convert a list of irs to a multichannel ir taking the channel chan of each ir
@@ -125,7 +586,36 @@ def fconvolve(in1,in2):
 #def ir_stretch(ir,threshold):
 
 # funcion para detectar outliers en un conjunto de IR
-#def ir_average(ir,reject_outliers=True,threshold): # con opcion de eliminar outliers
+def ir_average(ir_stack,method='mean',trim=0.1,threshold=3.5):
+    '''
+    promedia un conjunto de IR alineadas (Nrep x nsamples x nchan) a lo largo de las repeticiones
+    method puede ser 'mean', 'median', 'trimmed' (media descartando la fraccion trim en cada extremo,
+    al menos una repeticion por extremo si trim > 0 y hay 3 o mas)
+    o 'reject' que descarta (por canal) las repeticiones cuyo desvio rms respecto de la mediana 
+    supera en threshold desvios robustos (MAD) al desvio tipico. 
+    Devuelve la IR promedio y su desvio estandar (nsamples x nchan)
+    '''
+    if method == 'mean':
+        return np.mean(ir_stack,axis=0), np.std(ir_stack,axis=0)
+    elif method == 'median':
+        return np.median(ir_stack,axis=0), np.std(ir_stack,axis=0)
+    elif method == 'trimmed':
+        Nrep = ir_stack.shape[0]
+        ntrim = int(trim*Nrep)
+        if trim > 0 and Nrep >= 3:
+            ntrim = min(max(ntrim,1),(Nrep-1)//2)
+        return np.mean(np.sort(ir_stack,axis=0)[ntrim:Nrep-ntrim],axis=0), np.std(ir_stack,axis=0)
+    elif method == 'reject':
+        dev = np.sqrt(np.mean(np.square(ir_stack-np.median(ir_stack,axis=0)),axis=1)) # Nrep x nchan
+        dmed = np.median(dev,axis=0)
+        mad = 1.4826*np.median(np.abs(dev-dmed),axis=0)
+        keep = (dev <= dmed+threshold*mad+np.finfo(float).eps)[:,np.newaxis,:]
+        nkeep = np.sum(keep,axis=0)
+        ir = np.sum(ir_stack*keep,axis=0)/nkeep
+        ir_std = np.sqrt(np.sum(np.square(ir_stack-ir)*keep,axis=0)/nkeep)
+        return ir, ir_std
+    else:
+        raise ValueError("method must be 'mean', 'median', 'trimmed' or 'reject'")
 
 # fadeinout
 
@@ -171,27 +661,64 @@ def burst(data, nburst=3, dur=0.05, gap=0.02, fadein=0.01, fadeout=None, fs=4800
 #filtros
 
 def butter_bandpass(lowcut, highcut, fs, order=5, N=10000):
+    sos = butter_sos('band', order, (lowcut, highcut), fs)
+    w, h = _band_response(float(lowcut), float(highcut), float(fs), int(order), N)
+    return sos, w, h
+
+def butter_sos(btype, order, cutoffs, fs):
+    '''
+    filtro butter en formato sos de tipo btype ('band', 'highpass', 'lowpass') con frecuencias
+    de corte cutoffs (Hz) para fs. El diseno se guarda en un cache compartido con clave
+    (btype, order, cutoffs, fs), devuelve una copia que se puede modificar
+    '''
+    cutoffs = tuple(float(f) for f in np.atleast_1d(cutoffs))
+    return _butter_sos_cached(btype, int(order), cutoffs, float(fs)).copy()
+
+@lru_cache(maxsize=128)
+def _butter_sos_cached(btype, order, cutoffs, fs):
     nyq = 0.5 * fs
-    low = lowcut / nyq
-    high = highcut / nyq
-    sos = signal.butter(order, [low, high], btype='band', output='sos')
+    wn = [f / nyq for f in cutoffs]
+    sos = signal.butter(order, wn if len(wn) > 1 else wn[0], btype=btype, output='sos')
+    sos.flags.writeable = False
+    return sos
+
+@lru_cache(maxsize=32)
+def _band_response(lowcut, highcut, fs, order, N):
+    ''' respuesta en frecuencia (w, h) del pasabanda de butter_bandpass, solo lectura '''
+    sos = _butter_sos_cached('band', order, (lowcut, highcut), fs)
     w, h = signal.sosfreqz(sos,worN=N)
-    return sos, w, h
+    w.flags.writeable = False
+    h.flags.writeable = False
+    return w, h
+
+def clear_filter_cache():
+    ''' vacia el cache de disenos de filtros (butter_sos, butter_bandpass, A_weighting) '''
+    _butter_sos_cached.cache_clear()
+    _band_response.cache_clear()
+    _a_weighting_cached.cache_clear()
 
-def make_filterbank(fmin=62.5,noct=8,bwoct=1,fs=48000,order=5,N=10000,bankname='fbank_8_1',show=False):
+def make_filterbank(fmin=62.5,noct=8,bwoct=1,fs=48000,order=5,N=10000,bankname='fbank_8_1',show=False,
+                    multirate=False,qmax=64):
     '''
     Arma un banco de filtros de noct octavas desde la frecuencia fmin con bwoct filtros
     por octava con filtros butter de orden order en formato sos y los guarda en bankname
+    Si multirate es True cada banda se disena a fs/q con q (potencia de 2 hasta qmax) tal que la 
+    frecuencia superior de la banda quede debajo de fs/(8q), y FilterBank la aplica sobre una copia diezmada
     '''
     nfilt = (noct-1)*bwoct+1 # las octavas inicial y final inclusive
     fc = np.array([fmin* 2 ** (n * 1 / bwoct) for n in range(nfilt)])
     lf = 2. ** (-0.5/bwoct)*fc
     sos = np.zeros((nfilt,order,6),dtype=np.float64)
+    q = np.ones(nfilt,dtype=int)
     for n, f0 in enumerate(lf):
-        sos[n], w, h = butter_bandpass(f0,f0*2**(1/bwoct),fs,order,N)
+        if multirate:
+            while q[n] < qmax and f0*2**(1/bwoct) < fs/(16*q[n]):
+                q[n] *= 2
+        sos[n], w, h = butter_bandpass(f0,f0*2**(1/bwoct),fs/q[n],order,N)
         #if show:
         #    plt.semilogx((fs * 0.5 / np.pi) * w, abs(h))
-    np.savez_compressed(bankname,sos=sos,fc=fc,fs=fs,order=order)
+    np.savez_compressed(bankname,sos=sos,fc=fc,fs=fs,order=order,q=q)
+    FilterBank.clear(bankname)
     print('Banco de filtros generado: ' + str(noct) + ' octavas,' + str(bwoct) + ' bandas/octava,' +
           'desde ' + str(fmin) + ' Hz,' + 'Almacenada en archivo ' + bankname)
     #if show:
@@ -216,13 +743,142 @@ def load_filterbank(bankname):
             else:
                 headers[n] = str(int(fc[n])/1000) + 'k'
     return headers,fs
-    
+
+class FilterBank:
+    '''
+    Banco de filtros (sos, fc, fs) en memoria. FilterBank.get(bankname,fs) lo carga de bankname.npz
+    (o lo disena con make_filterbank si no existe) una sola vez y lo guarda en un registro con clave
+    (bankname, fs) que se invalida si el archivo cambia. filter() aplica todas las bandas a todos 
+    los canales y devuelve un array nbands x nsamples x nchan
+    q es el factor de diezmado de cada banda (bancos multirate, ver make_filterbank)
+    '''
+    _registry = {}
+
+    def __init__(self, sos, fc, fs, order=None, bankname=None, q=None):
+        self.sos = np.asarray(sos)
+        self.fc = np.asarray(fc)
+        self.fs = int(fs)
+        self.order = order
+        self.bankname = bankname
+        self.q = np.ones(self.sos.shape[0],dtype=int) if q is None else np.asarray(q,dtype=int)
+        self._h2 = {}
+
+    @property
+    def nbands(self):
+        return self.sos.shape[0]
+
+    @classmethod
+    def get(cls, bankname='fbank', fs=None, fs_default=48000):
+        '''
+        devuelve el banco bankname para la frecuencia de sampleo fs. Si no existe el archivo lo genera
+        (con noct y bwoct tomados del nombre, p.ej. fbank_8_1) a fs o fs_default. Si fs no coincide con 
+        la del archivo da error
+        '''
+        fname = bankname + '.npz'
+        if not os.path.exists(fname):
+            print('Generating new filter bank ')
+            fsdesign = fs or fs_default
+            if (len(bankname.split('_')) > 1):
+                (noct,bwoct) = [int(ss) for ss in bankname.split('_')[-2:]]
+                make_filterbank(noct=noct,bwoct=bwoct,bankname=bankname,fs=fsdesign)
+            else:
+                make_filterbank(bankname=bankname,fs=fsdesign)
+        mtime = os.stat(fname).st_mtime_ns
+        for (name, fsbank), (bank, mt) in cls._registry.items():
+            if name == bankname and (fs is None or fs == fsbank) and mt == mtime:
+                return bank
+        with np.load(fname) as fbank:
+            bank = cls(fbank['sos'],fbank['fc'],fbank['fs'],fbank['order'] if 'order' in fbank.files else None,bankname,
+                       fbank['q'] if 'q' in fbank.files else None)
+        if fs is not None and fs != bank.fs:
+            raise Exception('Inconsistent sample rate between audio file and filter bank')
+        cls._registry[(bankname,bank.fs)] = (bank,mtime)
+        return bank
+
+    @classmethod
+    def clear(cls, bankname=None):
+        ''' vacia el registro (solo las entradas de bankname si se especifica) '''
+        for key in list(cls._registry):
+            if bankname is None or key[0] == bankname:
+                del cls._registry[key]
+
+    def response2(self, nfft):
+        '''
+        |H|^2 de todas las bandas (nbands x nfft//2+1) en las frecuencias de rfft de largo nfft,
+        que es la respuesta de sosfiltfilt. Se calcula una vez por nfft 
+        '''
+        if nfft not in self._h2:
+            f = np.fft.rfftfreq(nfft,1/self.fs)
+            h2 = np.zeros((self.nbands,len(f)))
+            for n in range(self.nbands):
+                fsband = self.fs/self.q[n]
+                inband = f < fsband/2
+                _, h = signal.sosfreqz(self.sos[n],worN=f[inband],fs=fsband)
+                h2[n,inband] = np.abs(h)**2
+            h2.flags.writeable = False
+            self._h2[nfft] = h2
+        return self._h2[nfft]
+
+    def filter(self, data, workers=None, engine='iir'):
+        '''
+        filtra data (nsamples o nsamples x nchan) con todas las bandas (sosfiltfilt, fase cero) 
+        repartiendo las bandas entre workers threads. Devuelve array nbands x nsamples x nchan
+        Con engine='fft' hace una sola rfft de data con ceros agregados para que no se solapen las colas
+        de los filtros, la multiplica por |H|^2 de todas las bandas (response2) y vuelve con una irfft
+        (difiere de sosfiltfilt solo en los bordes, donde este extiende la senal)
+        Las bandas con q > 1 se filtran sobre una copia diezmada (cascada de diezmados por 2 compartida 
+        entre bandas) y se vuelven a fs con resample_poly. Como las bandas quedan debajo de fs/(8q) alcanzan
+        filtros FIR cortos, simetricos y con el retardo compensado, asi que se mantiene la alineacion.
+        La senal se rellena con ceros antes de diezmar para que los transitorios de los FIR no caigan 
+        sobre el comienzo de la IR
+        '''
+        if data.ndim == 1:
+            data = data[:,np.newaxis]
+        nsamples = data.shape[0]
+        if engine == 'fft':
+            # la duracion de la respuesta de la banda mas angosta define el relleno con ceros
+            r = self.fc[1]/self.fc[0] if self.nbands > 1 else 2.0
+            bw = self.fc[0]*(np.sqrt(r)-1/np.sqrt(r))
+            nfft = next_fast_len(nsamples + int(4*self.sos.shape[1]*self.fs/bw))
+            X = rfft(data,nfft,axis=0,workers=workers)
+            return irfft(self.response2(nfft)[:,:,np.newaxis]*X[np.newaxis],nfft,axis=1,workers=workers)[:,:nsamples]
+        elif engine != 'iir':
+            raise ValueError("engine must be 'iir' or 'fft'")
+        out = np.empty((self.nbands,)+data.shape)
+        qmax = int(np.max(self.q))
+        # ceros antes y despues (128 muestras a la tasa mas baja) para que los transitorios de los
+        # diezmados y de la interpolacion queden fuera de la senal
+        npad = 128*qmax if qmax > 1 else 0
+        decimated = {1: np.pad(data,((npad,npad),(0,0)))}
+        q = 1
+        while q < qmax:
+            decimated[2*q] = signal.resample_poly(decimated[q],1,2,axis=0,window=signal.firwin(17,0.5))
+            q *= 2
+        def _band(n):
+            q = self.q[n]
+            if q == 1:
+                out[n] = signal.sosfiltfilt(self.sos[n], data, axis=0)
+            else:
+                x = decimated[q]
+                # padlen de sosfiltfilt en muestras diezmadas: el mismo tiempo que a fs
+                padlen = max(3*(2*len(self.sos[n])+1)//q,1)
+                y = signal.sosfiltfilt(self.sos[n], x, axis=0, padlen=padlen)
+                out[n] = signal.resample_poly(y,q,1,axis=0,window=signal.firwin(8*q+1,1/q))[npad:npad+nsamples]
+        with ThreadPoolExecutor(max_workers=workers or min(self.nbands,os.cpu_count() or 1)) as pool:
+            list(pool.map(_band,range(self.nbands)))
+        return out
+
 def A_weighting(fs=48000):
     """
     Diseña filtro A para la frecuencia de sampleo fs
     adaptado de https://gist.github.com/endolith/148112
     Usage: B, A = A_weighting(fs) 
+    El diseno se hace una vez por fs (cache compartido, ver clear_filter_cache)
     """
+    return _a_weighting_cached(float(fs)).copy()
+
+@lru_cache(maxsize=16)
+def _a_weighting_cached(fs):
     z = [0, 0, 0, 0]
     p = [-2*np.pi*20.598997057568145,
          -2*np.pi*20.598997057568145,
@@ -235,32 +891,28 @@ def A_weighting(fs=48000):
     b, a = signal.zpk2tf(z, p, k)
     k /= abs(signal.freqs(b, a, [2*np.pi*1000])[1][0])
     z_d, p_d, k_d = signal.bilinear_zpk(z, p, k, fs)
-    return signal.zpk2sos(z_d, p_d, k_d)
+    sos = signal.zpk2sos(z_d, p_d, k_d)
+    sos.flags.writeable = False
+    return sos
    
 
 def apply_bands(data, bankname='fbank_10_1', fs=48000, norma=True):
     """
     Aplica el banco de filtros almacenado en bankname a la senal data
     por defecto normaliza las senales filtradas, sino hacer norma=false
+    devuelve nsamples x nbands (nsamples x nbands x nchan si data tiene varios canales)
     """
-    try:     
-        fbank = np.load(bankname + '.npz')
-    except:
-        make_filterbank(bankname=bankname)
-        fbank = np.load(bankname + '.npz')
+    fbank = FilterBank.get(bankname)
     data = data - np.mean(data)
-    nsamples = len(data)
-    nbands, order, dd = fbank['sos'].shape
-    data_filt = np.empty((nsamples,nbands))
-    for n in range(nbands):
-        temp = signal.sosfiltfilt(fbank['sos'][n], data)
-        if (norma):
-            temp = temp/np.amax(np.abs(temp))
-        data_filt[:,n] = temp
+    data_filt = np.moveaxis(fbank.filter(data),0,1)
+    if (norma):
+        data_filt /= np.amax(np.abs(data_filt),axis=0)
     # agregar fadeinfadeout    
+    if data.ndim == 1:
+        return data_filt[:,:,0]
     return data_filt    
 
-def spectrum(data_input, fs=48000):
+def spectrum(data_input, fs=48000, outputs=('s','amplitude','phase'), single=False, workers=None):
     """
     Computes the power spectrum (in dB) of signal data
     Can be used to obtain the transfer function from the impulse response 
@@ -269,6 +921,8 @@ def spectrum(data_input, fs=48000):
     sp['s'] power spectrum in dB 
     sp['amplitude'] amplitude of the FFT
     sp['phase] phase of the FFT for signal reconstruction
+    All channels are transformed in one rfft (workers threads). Only the keys in outputs are 
+    computed (the others stay 0) and single=True works in float32/complex64 
     """
     if type(data_input) is str:
         fs, data = wavfile.read(data_input + '.wav')
@@ -279,22 +933,49 @@ def spectrum(data_input, fs=48000):
     if data.ndim == 1:
         data = data[:,np.newaxis] # el array debe ser 2D
     nsamples, nchan = np.shape(data)
-    nf = int(np.ceil((nsamples+1)/2))
-    freq = fftfreq(nsamples, d=1/fs)
     listofkeys = ['nchan','f','s','amplitude','phase']
     sp = dict.fromkeys(listofkeys,0 )
     sp['nchan'] = nchan
-    sp['f'] = np.abs(freq[:nf])
-    sp['s'] = np.zeros((nchan,nf))
-    sp['amplitude'] = np.zeros((nchan,nf))
-    sp['phase'] = np.zeros((nchan,nf))
-    for n in np.arange(nchan):
-        s = rfft(data[:,n])
-        sp['amplitude'][n] = np.abs(s)
-        sp['phase'][n] = np.angle(s)
-        sp['s'][n] = 20*np.log10(sp['amplitude'][n])
+    sp['f'] = np.fft.rfftfreq(nsamples, d=1/fs)
+    data = data.astype(np.float32 if single else np.float64, copy=False)
+    s = rfft(data.T, axis=-1, workers=workers) # nchan x nf
+    if 'phase' in outputs:
+        sp['phase'] = np.angle(s)
+    if 'amplitude' in outputs or 's' in outputs:
+        amplitude = np.abs(s)
+        del s
+        if 'amplitude' in outputs:
+            sp['amplitude'] = amplitude
+        if 's' in outputs:
+            sp['s'] = 20*np.log10(amplitude) if 'amplitude' in outputs else np.multiply(np.log10(amplitude,out=amplitude),20,out=amplitude)
     return sp
 
+def smooth_spectrum(s, f, noct=3, db=False, logf=False, fmin=20.0, fmax=None, ppo=48, axis=-1):
+    """
+    Suavizado de 1/noct de octava del espectro s (lineal en potencia o en dB si db=True) con frecuencias f
+    a lo largo de axis, para todos los canales (o cualquier cantidad de dimensiones) a la vez.
+    Cada ventana [fc 2^(-1/2noct), fc 2^(1/2noct)] se promedia con la suma acumulada, O(N) para cualquier ancho
+    Si logf es True devuelve el resultado en una grilla logaritmica de ppo puntos por octava entre fmin y fmax
+    (mucho mas compacta para graficar), sino en las mismas frecuencias f
+    Returns (fs, ss) frecuencias y espectro suavizado (en dB si db=True)
+    """
+    s = np.moveaxis(np.asarray(s),axis,-1)
+    x = np.power(10.0,s/10.0) if db else s
+    csum = np.concatenate((np.zeros(x.shape[:-1]+(1,)),np.cumsum(x,axis=-1)),axis=-1)
+    if logf:
+        fmax = f[-1] if fmax is None else min(fmax,f[-1])
+        fc = fmin*np.power(2.0,np.arange(int(np.floor(ppo*np.log2(fmax/fmin)))+1)/ppo)
+    else:
+        fc = f
+    lo = np.searchsorted(f,fc*np.power(2.0,-0.5/noct))
+    hi = np.searchsorted(f,fc*np.power(2.0,0.5/noct),side='right')
+    lo = np.minimum(lo,len(f)-1)
+    hi = np.maximum(hi,lo+1)
+    ss = (csum[...,hi]-csum[...,lo])/(hi-lo)
+    if db:
+        ss = 10*np.log10(np.maximum(ss,np.finfo(float).tiny))
+    return fc, np.moveaxis(ss,-1,axis)
+
 def crossspectrum(data_input, ch1=0, ch2=1, fs=48000):
     """
     Computes the cross/auto power spectrum between two channels of signal data 
@@ -319,12 +1000,10 @@ def crossspectrum(data_input, ch1=0, ch2=1, fs=48000):
     nsamples, nchan = np.shape(data)
     if nchan == 1:
         raise TypeError('You must provide at least 2 channels')    
-    nf = int(np.ceil((nsamples+1)/2))
-    freq = fftfreq(nsamples, d=1/fs)
     listofkeys = ['chans','f','S21','S12','S11','S22','H']
     xsp = dict.fromkeys(listofkeys,0 )
     xsp['chans'] = (ch1,ch2)
-    xsp['f'] = np.abs(freq[:nf])
+    xsp['f'] = np.fft.rfftfreq(nsamples, d=1/fs)
     sp1 = rfft(data[:,ch1])
     sp2 = rfft(data[:,ch2])
     xsp['S21'] = sp1*np.conjugate(sp2)
@@ -336,58 +1015,317 @@ def crossspectrum(data_input, ch1=0, ch2=1, fs=48000):
     xsp['H'] = sp2/(sp1+eps)
     return xsp
 
+def csd_matrix(data_input, nperseg=4096, noverlap=None, fs=48000, window='hann', chunk=64, workers=None):
+    """
+    Welch cross power spectral density between all pairs of channels of data (nsamples x nchan)
+    with the scaling of signal.csd (density, detrend constant, one sided, mean of segments).
+    Each segment is transformed once for all channels and the nchan x nchan Hermitian matrix is 
+    accumulated with a batched product over chunk segments at a time. Only the upper triangle is kept.
+    Returns a dictionary csd with keys
+    csd['f'] frequencies
+    csd['pairs'] (i, j) channel indices of each column, i <= j
+    csd['S'] cross spectra nf x npairs, S[:,p] = <conj(X_i) X_j> (same as signal.csd(x_i, x_j))
+    csd['coherence'] magnitude squared coherence nf x npairs
+    Use csd_unpack to obtain the full nf x nchan x nchan matrix 
+    """
+    if type(data_input) is str:
+        fs, data = wavfile.read(data_input + '.wav')
+    elif type(data_input) is np.ndarray:
+        data = data_input
+    else:
+        raise TypeError('First argument must be an nparray or a filename')    
+    if data.ndim == 1:
+        data = data[:,np.newaxis] # el array debe ser 2D
+    nsamples, nchan = np.shape(data)
+    if noverlap is None:
+        noverlap = nperseg//2
+    step = nperseg-noverlap
+    win, scale = _stft_window(window, nperseg, fs)
+    frames = np.lib.stride_tricks.sliding_window_view(data, nperseg, axis=0)[::step] # nseg x nchan x nperseg
+    nseg = frames.shape[0]
+    f = np.fft.rfftfreq(nperseg, 1/fs)
+    S = np.zeros((len(f),nchan,nchan),dtype=complex)
+    for n in range(0,nseg,chunk):
+        x = frames[n:n+chunk] - np.mean(frames[n:n+chunk],axis=-1,keepdims=True)
+        x *= win
+        X = rfft(x,axis=-1,workers=workers).transpose(2,0,1) # nf x nseg x nchan
+        S += np.matmul(np.conj(X).transpose(0,2,1),X)
+    S *= scale/nseg
+    if nperseg % 2:
+        S[1:] *= 2
+    else:
+        S[1:-1] *= 2
+    iu, ju = np.triu_indices(nchan)
+    listofkeys = ['nchan','f','pairs','S','coherence']
+    csd = dict.fromkeys(listofkeys,0 )
+    csd['nchan'] = nchan
+    csd['f'] = f
+    csd['pairs'] = np.stack((iu,ju),axis=1)
+    csd['S'] = S[:,iu,ju]
+    auto = np.real(np.diagonal(S,axis1=1,axis2=2))
+    csd['coherence'] = np.abs(csd['S'])**2/np.maximum(auto[:,iu]*auto[:,ju],np.finfo(float).tiny)
+    return csd
+
+def csd_unpack(csd):
+    """
+    full Hermitian cross spectral matrix nf x nchan x nchan from the upper triangle of csd_matrix
+    (the transfer function from channel i to j is S[:,i,j]/S[:,i,i])
+    """
+    nchan = csd['nchan']
+    iu, ju = csd['pairs'].T
+    S = np.empty((len(csd['f']),nchan,nchan),dtype=csd['S'].dtype)
+    S[:,iu,ju] = csd['S']
+    S[:,ju,iu] = np.conj(csd['S'])
+    return S
+
 def spectrogram(data, **kwargs):
     """
-    Computes the spectrogram and the analytic envelope of the signal
+    Computes the spectrogram and the analytic envelope of the signal. data is a nsamples x nchan array
+    (all channels are framed at once, see stft) or an iterable of blocks (see stft_blocks).
+    The envelope is computed block by block with a FIR Hilbert filter of envtaps taps (default 2047,
+    see stft_blocks) so memory is bounded by the output also for long multichannel recordings
     """
     #force to power of next fast FFT length
     windowSize = next_fast_len(kwargs['windowSize'])
     overlap = kwargs['overlap']
-    if data.ndim == 1:
-        data = data[:,np.newaxis] # el array debe ser 2D
-    nsamples, nchan = np.shape(data)
-    nt = int(np.floor((nsamples-windowSize)/(windowSize-overlap)))+1
-    nenv = next_fast_len(nsamples)
+    envtaps = kwargs.get('envtaps',2047)
+    if isinstance(data, np.ndarray):
+        if data.ndim == 1:
+            data = data[:,np.newaxis] # el array debe ser 2D
+        f, t, s = stft(data, windowSize, overlap, kwargs['fs'], kwargs['windowType'])
+        h = _hilbert_fir(envtaps)
+        buf = np.zeros((len(h)//2,data.shape[1]))
+        env = []
+        for n in range(0,data.shape[0],65536):
+            e, buf = _envelope_step(buf, data[n:n+65536], h, flush=n+65536>=data.shape[0])
+            env.append(e)
+        env = np.concatenate(env,axis=1)
+    else:
+        f = np.fft.rfftfreq(windowSize, 1/kwargs['fs'])
+        blocks = list(stft_blocks(data, windowSize, overlap, kwargs['fs'], kwargs['windowType'], env=True, envtaps=envtaps))
+        t = np.concatenate([b[0] for b in blocks])
+        s = np.concatenate([b[1] for b in blocks],axis=2)
+        env = np.concatenate([b[2] for b in blocks],axis=1)
+    nchan, nsamples = env.shape
     # Dict for spectrogram
     listofkeys = ['nchan','nsamples','f','t','s','env','nt','nf','df','window','overlap']
     spec = dict.fromkeys(listofkeys,0 )
     spec['nchan'] = nchan
     spec['nf'] = windowSize//2+1
-    spec['s'] = np.zeros((nchan,spec['nf'],nt))
-    spec['env'] = np.zeros((nchan,nenv))
     spec['window'] = windowSize
     spec['overlap'] = overlap
-    spec['nt'] = nt
     spec['nsamples']=nsamples
-    for n in np.arange(nchan):
-        env = np.abs(signal.hilbert(data[:,n],nenv))  
-        f,t,spectro = signal.spectrogram(data[:,n], kwargs['fs'], window=kwargs['windowType'], nperseg=windowSize, noverlap=overlap)
-        spec['t'] = t
-        spec['df'] = f[1]
-        spec['env'][n] = env
-        if kwargs['logf']:
-            lf = np.power(2,np.linspace(np.log2(f[1]),np.log2(f[-1]),spec['nf']))
-            fint = interp1d(f,spectro.T,fill_value="extrapolate")
-            spec['f'] = lf
-            spec['s'][n] = fint(lf).T
-        else:
-            spec['f'] = f
-            spec['s'][n] = spectro
-        if kwargs['normalized']:
-            spec['s'][n] = spec['s'][n]/np.max(spec['s'][n])
-            spec['env'][n] = spec['env'][n]/np.max(spec['env'][n])    
+    spec['t'], spec['s'] = t, s
+    spec['nt'] = len(spec['t'])
+    spec['df'] = f[1]
+    spec['env'] = env
+    if kwargs['logf']:
+        spec['f'], spec['s'] = logf_resample(spec['s'], f)
+    else:
+        spec['f'] = f
+    if kwargs['normalized']:
+        spec['s'] /= np.max(spec['s'],axis=(1,2),keepdims=True)
+        spec['env'] /= np.max(spec['env'],axis=1,keepdims=True)
     return spec        
 
+def stft(data, windowSize, overlap, fs=48000, window='hann', chunk=256):
+    """
+    Power spectral density frames of all channels of data (nsamples x nchan) with the same scaling as
+    signal.spectrogram (density, detrend constant, one sided). The frames are strided views of data 
+    processed chunk frames at a time so memory is bounded by the output.
+    Returns f, t and s (nchan x nf x nt)
+    """
+    if data.ndim == 1:
+        data = data[:,np.newaxis] # el array debe ser 2D
+    nsamples, nchan = np.shape(data)
+    step = windowSize-overlap
+    nt = max((nsamples-overlap)//step,0)
+    f = np.fft.rfftfreq(windowSize, 1/fs)
+    t = (np.arange(nt)*step + windowSize/2)/fs
+    win, scale = _stft_window(window, windowSize, fs)
+    frames = np.lib.stride_tricks.sliding_window_view(data, windowSize, axis=0)[::step] # nt x nchan x windowSize
+    s = np.empty((nchan,len(f),nt))
+    for n in range(0,nt,chunk):
+        s[:,:,n:n+chunk] = _stft_power(frames[n:n+chunk],win,scale).transpose(1,2,0)
+    return f, t, s
+
+def stft_blocks(blocks, windowSize, overlap, fs=48000, window='hann', env=False, envtaps=2047):
+    """
+    Streaming version of stft for long recordings: blocks is an iterable of arrays (nsamples x nchan)
+    (e.g. chunks of load_pcm with mmap or the generate *_blocks generators). The samples that do not 
+    complete a frame are kept for the next block. Yields (t, s) with s nchan x nf x nt for each block
+    With env=True it also yields the analytic envelope (nchan x n) of the samples already covered by a
+    FIR Hilbert filter of envtaps taps (overlap-save, envtaps//2 samples behind the input) as (t, s, e), 
+    and a last (t, s, e) with no frames and the envelope of the remaining samples. The envelope differs 
+    from signal.hilbert by about 1% of its maximum above fs/500 with the default envtaps
+    """
+    step = windowSize-overlap
+    win, scale = _stft_window(window, windowSize, fs)
+    buf = None
+    n0 = 0 # muestra absoluta del inicio de buf
+    if env:
+        h = _hilbert_fir(envtaps)
+        ebuf = None
+    for block in blocks:
+        if block.ndim == 1:
+            block = block[:,np.newaxis]
+        if env:
+            if ebuf is None:
+                ebuf = np.zeros((len(h)//2,block.shape[1]))
+            e, ebuf = _envelope_step(ebuf, block, h)
+        buf = block if buf is None else np.concatenate((buf,block),axis=0)
+        nt = max((len(buf)-overlap)//step,0)
+        if nt == 0 and not (env and e.shape[1]):
+            continue
+        frames = np.lib.stride_tricks.sliding_window_view(buf[:(nt-1)*step+windowSize], windowSize, axis=0)[::step] \
+                 if nt else np.zeros((0,buf.shape[1],windowSize))
+        t = (n0 + np.arange(nt)*step + windowSize/2)/fs
+        s = _stft_power(frames,win,scale).transpose(1,2,0)
+        yield (t, s, e) if env else (t, s)
+        buf = buf[nt*step:]
+        n0 += nt*step
+    if env and ebuf is not None:
+        e, _ = _envelope_step(ebuf, np.zeros((0,ebuf.shape[1])), h, flush=True)
+        yield np.zeros((0,)), np.zeros((ebuf.shape[1],windowSize//2+1,0)), e
+
+@lru_cache(maxsize=8)
+def _hilbert_fir(ntaps):
+    ''' transformador de Hilbert FIR de ntaps (impar) coeficientes con ventana de Blackman '''
+    M = ntaps//2
+    n = np.arange(-M,M+1)
+    h = np.where(n % 2 == 1,2/(np.pi*np.where(n == 0,1,n)),0)*np.blackman(2*M+1)
+    h.flags.writeable = False
+    return h
+
+def _envelope_step(buf, block, h, flush=False):
+    '''
+    overlap-save de la envolvente analitica: buf tiene las ultimas muestras ya recibidas (len(h)//2 
+    de contexto mas las pendientes). Devuelve la envolvente (nchan x n) de las muestras que ya tienen 
+    len(h)//2 muestras posteriores (todas si flush, completando con ceros) y el nuevo buf
+    '''
+    M = len(h)//2
+    if block.ndim == 1:
+        block = block[:,np.newaxis]
+    buf = np.concatenate((buf,block) + ((np.zeros((M,buf.shape[1])),) if flush else ()),axis=0)
+    n = len(buf)-2*M
+    if n <= 0:
+        return np.zeros((buf.shape[1],0)), buf
+    xh = oaconvolve(buf, h[:,np.newaxis], mode='valid', axes=0)
+    return np.sqrt(buf[M:M+n]**2+xh**2).T, buf[n:]
+
+def _stft_window(window, windowSize, fs):
+    if window == 'hanning':
+        window = 'hann' # nombre viejo que ya no acepta get_window
+    win = signal.get_window(window, windowSize)
+    return win, 1.0/(fs*np.sum(win**2))
+
+def _stft_power(frames, win, scale):
+    ''' densidad espectral de potencia (nframes x nchan x nf) de frames (nframes x nchan x windowSize) '''
+    x = frames - np.mean(frames,axis=-1,keepdims=True)
+    x *= win
+    p = np.abs(rfft(x,axis=-1))**2
+    p *= scale
+    if len(win) % 2:
+        p[...,1:] *= 2
+    else:
+        p[...,1:-1] *= 2
+    return p
+
+def spectrogram_pyramid(data, windowSize=1024, overlap=512, fs=48000, window='hann', minframes=512, maxbins=1024):
+    """
+    Builds a pyramid of spectrogram levels for fast zoom of long recordings. Level 0 is the stft of data
+    (nsamples x nchan array or iterable of blocks, see stft_blocks) in float32 and each following level 
+    averages pairs of frames of the previous one (and pairs of frequency bins while there are more than 
+    maxbins, more than any screen needs) until less than minframes frames remain. Returns a dictionary with keys 'fs', 'nchan', 'smax' (maximum per channel),
+    and 'levels', a list of (f, t, s) with s nchan x nf x nt. See pyramid_tile, save_pyramid, load_pyramid
+    """
+    if isinstance(data, np.ndarray):
+        f, t, s = stft(data, windowSize, overlap, fs, window)
+    else:
+        f = np.fft.rfftfreq(windowSize, 1/fs)
+        blocks = list(stft_blocks(data, windowSize, overlap, fs, window))
+        t = np.concatenate([b[0] for b in blocks])
+        s = np.concatenate([b[1].astype(np.float32) for b in blocks],axis=2)
+    s = s.astype(np.float32, copy=False)
+    listofkeys = ['fs','nchan','smax','levels']
+    pyr = dict.fromkeys(listofkeys,0)
+    pyr['fs'] = fs
+    pyr['nchan'] = s.shape[0]
+    pyr['smax'] = np.max(s,axis=(1,2))
+    pyr['levels'] = [(f, t, s)]
+    while len(t) >= 2*minframes:
+        nt = len(t)//2
+        t = 0.5*(t[:2*nt:2]+t[1:2*nt:2])
+        s = 0.5*(s[:,:,:2*nt:2]+s[:,:,1:2*nt:2])
+        if len(f) > maxbins:
+            nf = len(f)//2
+            f = 0.5*(f[:2*nf:2]+f[1:2*nf:2])
+            s = 0.5*(s[:,:2*nf:2]+s[:,1:2*nf:2])
+        pyr['levels'].append((f, t, s))
+    return pyr
+
+def pyramid_tile(pyr, tmin, tmax, fmin, fmax, npixt=1000, npixf=500, chan=0):
+    """
+    Returns (f, t, s) of channel chan between tmin,tmax and fmin,fmax from the coarsest level of the
+    pyramid that still has at least npixt frames and npixf bins in that range, or as many as level 0
+    (views, nothing is computed)
+    """
+    def _count(f, t):
+        return (np.searchsorted(t,tmax) - np.searchsorted(t,tmin), np.searchsorted(f,fmax) - np.searchsorted(f,fmin))
+    nt0, nf0 = _count(*pyr['levels'][0][:2])
+    for f, t, s in reversed(pyr['levels']):
+        nt, nf = _count(f, t)
+        if nt >= min(npixt,nt0) and nf >= min(npixf,nf0):
+            break
+    it = slice(max(np.searchsorted(t,tmin)-1,0), np.searchsorted(t,tmax)+1)
+    jf = slice(max(np.searchsorted(f,fmin)-1,0), np.searchsorted(f,fmax)+1)
+    return f[jf], t[it], s[chan,jf,it]
+
+def save_pyramid(pyr, filename):
+    ''' stores the spectrogram pyramid in filename.npz '''
+    arrays = {'fs': pyr['fs'], 'smax': pyr['smax'], 'nlevels': len(pyr['levels'])}
+    for n, (f, t, s) in enumerate(pyr['levels']):
+        arrays.update({f'f{n}': f, f't{n}': t, f's{n}': s})
+    np.savez_compressed(filename, **arrays)
+
+def load_pyramid(filename):
+    ''' loads a spectrogram pyramid stored by save_pyramid '''
+    with np.load(filename + '.npz') as npz:
+        listofkeys = ['fs','nchan','smax','levels']
+        pyr = dict.fromkeys(listofkeys,0)
+        pyr['fs'] = int(npz['fs'])
+        pyr['smax'] = npz['smax']
+        pyr['levels'] = [(npz[f'f{n}'], npz[f't{n}'], npz[f's{n}']) for n in range(int(npz['nlevels']))]
+        pyr['nchan'] = pyr['levels'][0][2].shape[0]
+    return pyr
+
+def logf_resample(s, f, axis=-2):
+    """
+    Linear interpolation of s (frequencies along axis) from the linear grid f to a logarithmic grid with
+    the same number of points between f[1] and f[-1]. Indices and weights are cached per grid.
+    Returns lf, s_log
+    """
+    lf, idx, w = _logf_interp(len(f), float(f[1]))
+    s = np.moveaxis(s,axis,-1)
+    s_log = s[...,idx]*(1.0-w) + s[...,idx+1]*w
+    return lf, np.moveaxis(s_log,-1,axis)
+
+@lru_cache(maxsize=16)
+def _logf_interp(nf, df):
+    f = np.arange(nf)*df
+    lf = np.power(2,np.linspace(np.log2(f[1]),np.log2(f[-1]),nf))
+    idx = np.clip(np.searchsorted(f,lf,side='right')-1,0,nf-2)
+    w = (lf-f[idx])/df
+    for x in (lf, idx, w):
+        x.flags.writeable = False
+    return lf, idx, w
+
 def hipass_filter(data, **kwargs):
-    nyq = 0.5 * kwargs['fs']
-    low = kwargs['lowcut'] / nyq
-    sos = signal.butter(kwargs['order'], low, btype='highpass', output='sos')
+    sos = butter_sos('highpass', kwargs['order'], kwargs['lowcut'], kwargs['fs'])
     return signal.sosfiltfilt(sos, data, axis=0)
 
 def lowpass_filter(data, **kwargs):
-    nyq = 0.5 * kwargs['fs']
-    hicut = kwargs['hicut'] / nyq
-    sos = signal.butter(kwargs['order'], hicut, btype='lowpass', output='sos')
+    sos = butter_sos('lowpass', kwargs['order'], kwargs['hicut'], kwargs['fs'])
     return signal.sosfiltfilt(sos, data, axis=0)    
 
 
@@ -2,7 +2,8 @@ import numpy as np
 from scipy import signal
 from scipy.io import wavfile
 from scipy.stats import linregress, kurtosis
-from .process import make_filterbank, A_weighting
+from concurrent.futures import ProcessPoolExecutor
+from .process import A_weighting, FilterBank
 eps = np.finfo(float).eps
 
 def revtime(ir_input, method='RT20', fs=48000, tmax=3.0):
@@ -104,7 +105,7 @@ def clarity(ir_input, fs=48000, tmax = 3.0):
     return C80, C50, TS    
         
 
-def paracoustic(ir, method='RT20', bankname='fbank', tmax=3.0, fs_default=48000):
+def paracoustic(ir, method='RT20', bankname='fbank', tmax=3.0, fs_default=48000, engine='iir'):
     '''
     Calcula los siguientes parametros acusticos POR BANDAS con los nombres de las keys correspondientes
     Reververacion: 'RT30' (o el metodo que se pida), 'EDT'
@@ -116,37 +117,24 @@ def paracoustic(ir, method='RT20', bankname='fbank', tmax=3.0, fs_default=48000)
     devueve un diccionario rev que tiene las siguientes keys: nchan (num canales), nbands (num bandas), fc (frecuencias)
     tr20 (o tr30 o EDT, array de nbands x nchan con los tiempos de reverberancia) tfit, lfit, dchr, lvalues son 
     las salidas de revtime (ver) para cada banda. La banda 0 es wideband (fc = 1)
+    engine='fft' filtra todas las bandas con una sola rfft/irfft en lugar de sosfiltfilt (ver FilterBank.filter)
     '''
     # si bankname es None lo hace wideband
     # dar la opcion de no calcular el filtro A
-    try:     
-        fbank = np.load(bankname + '.npz')
-    except:
-        print('Generating new filter bank ')
-        try: 
-            fs, _ = wavfile.read(ir + '.wav')
-        except:
-            #raise Exception('Cannot infer sample rate. Please provide wav file or filter bank with specified sample rate')    
-            fs = fs_default
-        if (len(bankname.split('_')) > 1):
-            (noct,bwoct) = [int(ss) for ss in bankname.split('_')[-2:]]
-            make_filterbank(noct=noct,bwoct=bwoct,bankname=bankname,fs=fs)
-        else:
-            make_filterbank(bankname='fbank',fs=fs)    
-        fbank = np.load(bankname + '.npz')
+    # el banco se carga (o se genera con noct y bwoct del nombre) una sola vez, ver FilterBank.get
     if type(ir) is str:
         fs, data = wavfile.read(ir + '.wav')
-        if fs != fbank['fs']:
-            raise Exception('Inconsistent sample rate between audio file and filter bank')
+        fbank = FilterBank.get(bankname, fs=fs)
     elif type(ir) is np.ndarray:
         data = ir
-        fs = fbank['fs']
+        fbank = FilterBank.get(bankname, fs_default=fs_default)
+        fs = fbank.fs
         print('Using sample rate from filter bank:' + str(fs))
     else:
         raise TypeError('Input must be ndarray or filename')    
     if data.ndim == 1:
         data = data[:,np.newaxis] # el array debe ser 2D
-    nbands, _, _ = fbank['sos'].shape
+    nbands = fbank.nbands
     # some stats
     pstat = irstats(data, fs=fs)
     tmixing = np.mean(pstat['mixing'][0,:])
@@ -174,6 +162,7 @@ def paracoustic(ir, method='RT20', bankname='fbank', tmax=3.0, fs_default=48000)
     #print(int(tnoise*fs))
     #print(data.shape)
     sos_a = A_weighting(fs)
+    bands_filt = fbank.filter(data/np.amax(np.abs(data)),engine=engine)
     for n in range(nbands+2):
         if n==nbands:
             pars['fc'][n] = 'A'
@@ -182,8 +171,8 @@ def paracoustic(ir, method='RT20', bankname='fbank', tmax=3.0, fs_default=48000)
             pars['fc'][n] = 'Flat'
             data_filt = data            
         else:    
-            pars['fc'][n] = str(int(fbank['fc'][n]))
-            data_filt = signal.sosfiltfilt(fbank['sos'][n], data/np.amax(np.abs(data)), axis=0)
+            pars['fc'][n] = str(int(fbank.fc[n]))
+            data_filt = bands_filt[n]
         pars['EDT'][n], *_ = revtime(data_filt,'EDT',fs,tmax)
         pars[method][n], pars['tfit'][n], pars['lfit'][n], pars['schr'][n], pars['SNR'][n], pars['rvalue'][n] = revtime(data_filt,method,fs,tmax)
         pars['C80'][n], pars['C50'][n], pars['TS'][n] = clarity(data_filt,fs,tmax)
@@ -291,6 +280,76 @@ def irstats(ir, window=0.01, overlap=0.005, fs=48000):
     pars['tnoise'][0,:] = pars['tframe'][nnoise][:,0]
     return pars    
 
+def image_sources(room_dim, src, order=10, beta=0.9):
+    '''
+    Posiciones de las fuentes imagen de src (nsrc x 3) en una sala rectangular de dimensiones room_dim
+    (Lx, Ly, Lz) hasta orden de reflexion order. beta es el coeficiente de reflexion (escalar o 6 valores
+    para las paredes x=0, x=Lx, y=0, y=Ly, z=0, z=Lz)
+    Devuelve las posiciones (nsrc x nimg x 3) y la atenuacion por reflexiones de cada imagen (nimg)
+    '''
+    L = np.asarray(room_dim,dtype=float)
+    src = np.atleast_2d(np.asarray(src,dtype=float))
+    beta = np.broadcast_to(np.asarray(beta,dtype=float),(6,)).reshape(3,2)
+    m = np.arange(-order,order+1)
+    # indices (p,m) por eje: la imagen es (1-2p)x + 2mL con |m-p| reflexiones en la pared 0 y |m| en la pared L
+    p = np.stack(np.meshgrid([0,1],[0,1],[0,1],indexing='ij'),axis=-1).reshape(-1,1,3)
+    mm = np.stack(np.meshgrid(m,m,m,indexing='ij'),axis=-1).reshape(1,-1,3)
+    p, mm = [np.broadcast_to(x,(8,len(m)**3,3)).reshape(-1,3) for x in (p,mm)]
+    n0 = np.abs(mm-p) # reflexiones en la pared de coordenada 0
+    n1 = np.abs(mm) # reflexiones en la pared de coordenada L
+    keep = np.sum(n0+n1,axis=1) <= order
+    p, mm, n0, n1 = p[keep], mm[keep], n0[keep], n1[keep]
+    att = np.prod(beta[:,0]**n0*beta[:,1]**n1,axis=1)
+    pos = (1-2*p)[np.newaxis,:,:]*src[:,np.newaxis,:] + 2*mm[np.newaxis,:,:]*L
+    return pos, att
+
+def _render_images(pos, att, rec, nsamples, nfrac, c, fs):
+    '''
+    Suma los aportes de las imagenes pos (nsrc x nimg x 3) con atenuacion att en los receptores rec (nrec x 3)
+    con retardo fraccionario (sinc con ventana de nfrac muestras) en un array nsrc x nsamples x nrec
+    '''
+    nsrc, nimg, _ = pos.shape
+    nrec = rec.shape[0]
+    d = np.linalg.norm(pos[:,:,np.newaxis,:]-rec[np.newaxis,np.newaxis,:,:],axis=-1) # nsrc x nimg x nrec
+    delay = d*fs/c
+    amp = att[np.newaxis,:,np.newaxis]/(4*np.pi*np.maximum(d,1e-3))
+    k = np.arange(-nfrac//2+1,nfrac//2+1)
+    n0 = np.floor(delay).astype(int)
+    frac = delay-n0
+    idx = n0[...,np.newaxis]+k # nsrc x nimg x nrec x nfrac
+    w = np.sinc(k-frac[...,np.newaxis])*(0.5+0.5*np.cos(2*np.pi*(k-frac[...,np.newaxis])/nfrac))*amp[...,np.newaxis]
+    valid = (idx >= 0) & (idx < nsamples)
+    flat = (np.arange(nsrc)[:,None,None,None]*nsamples+idx)*nrec + np.arange(nrec)[None,None,:,None]
+    ir = np.bincount(flat[valid],weights=w[valid],minlength=nsrc*nsamples*nrec)
+    return ir.reshape(nsrc,nsamples,nrec)
+
+def shoebox_ir(room_dim, src, rec, order=10, beta=0.9, dur=None, c=343.0, nfrac=32, chunk=4096, workers=None, fs=48000):
+    '''
+    Respuestas impulso de una sala rectangular (Lx, Ly, Lz) por el metodo de las fuentes imagen para cada par
+    fuente src (nsrc x 3) y receptor rec (nrec x 3) hasta orden order, con coeficiente de reflexion beta
+    (escalar o 6 valores, ver image_sources), retardos fraccionarios y duracion dur (por defecto la de la 
+    imagen mas lejana). Las imagenes se procesan de a chunk y si workers > 1 se reparten entre procesos
+    Devuelve array nsrc x nsamples x nrec (cada fuente con los receptores como canales como las de ir_extract)
+    '''
+    src = np.atleast_2d(np.asarray(src,dtype=float))
+    rec = np.atleast_2d(np.asarray(rec,dtype=float))
+    pos, att = image_sources(room_dim, src, order, beta)
+    dmax = np.max(np.linalg.norm(pos[:,:,np.newaxis,:]-rec[np.newaxis,np.newaxis,:,:],axis=-1))
+    if dur is None:
+        dur = dmax/c + nfrac/fs
+    nsamples = int(dur*fs)
+    chunks = [(pos[:,n:n+chunk],att[n:n+chunk]) for n in range(0,len(att),chunk)]
+    ir = np.zeros((src.shape[0],nsamples,rec.shape[0]))
+    if workers is not None and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_render_images,p,a,rec,nsamples,nfrac,c,fs) for p,a in chunks]
+            for future in futures:
+                ir += future.result()
+    else:
+        for p, a in chunks:
+            ir += _render_images(p,a,rec,nsamples,nfrac,c,fs)
+    return ir
+
 # echo density 
 #     
 #def find_modes # encuentra modos hasta una frecuencia
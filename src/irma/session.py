@@ -3,15 +3,16 @@ import yaml
 import datetime
 import numpy as np
 from scipy.io import wavfile
-from .generate import sweep
-from .io import play_rec
+from .generate import sweep_library
+from .io import play_rec, play_rec_adaptive
 from .process import ir_extract
+from .room import shoebox_ir
 
 class RecordingSession:
     def __init__(self, session_id, speakers=None, microphones=None,speaker_pos=None,microphone_pos=None,
                  inchan=[1,2],outchan=[1,2],loopback=None,sampling_rate=48000,rtype=None,
                  date=None,hour=None,recordingpath=None,sweepfile=None,sweeprange=[30,22000],
-                 sweeprep=1,sweeppost=2.0,sweepdur=10.0):
+                 sweeprep=1,sweeppost=2.0,sweepdur=10.0,sweeplib=None):
         self.session_id = session_id
         self.speakers = speakers or [1]
         self.microphones = microphones or [1]
@@ -26,13 +27,12 @@ class RecordingSession:
         self.hour = hour or datetime.datetime.now().strftime("%H:%M:%S")
         self.comments = ""
         self.saved = False
+        self.sweep_params = None
         if sweepfile is None:
-            srkhz = self.sampling_rate//1000
-            maxrange = sweeprange[1]//1000
-            sweepfile = f"sweep_x{sweeprep}_{srkhz}k_{int(sweepdur)}s_{sweeprange[0]}_{maxrange}k"
-            print("generating sweep " + sweepfile)
-            sweep(T=sweepdur,fs=self.sampling_rate,f1=sweeprange[0],f2=sweeprange[1],Nrep=sweeprep,
-                  filename=sweepfile,post=sweeppost)    
+            # solo se genera si no esta en la biblioteca de excitaciones
+            self.sweep_params = dict(T=sweepdur,f1=sweeprange[0],f2=sweeprange[1],Nrep=sweeprep,post=sweeppost)
+            sweepfile = sweep_library(T=sweepdur,fs=self.sampling_rate,f1=sweeprange[0],f2=sweeprange[1],
+                                      Nrep=sweeprep,post=sweeppost,libpath=sweeplib)
         self.sweep_file = sweepfile
         self.recording_path = recordingpath  or ""
         self.recordings = []
@@ -50,7 +50,7 @@ class RecordingSession:
             raise ValueError(f"Name already exists please use take a different take number")
         return prefix
 
-    def record_ir(self,speaker,microphone,direction=None,take=1,comment='',overwrite=False):
+    def record_ir(self,speaker,microphone,direction=None,take=1,comment='',overwrite=False,snr=None,maxrep=20):
         if self.loopback:
             nchannels = len(self.input_channels)-1 
             chan_loop = self.input_channels.index(self.loopback)
@@ -60,12 +60,20 @@ class RecordingSession:
         valid = True
         prefix = self.generate_audio_file_prefix(speaker, microphone, direction, nchannels, self.loopback, self.rtype, int(take),overwrite)
         print("Recording ... "+prefix)
-        rec_temp = play_rec(self.sweep_file,os.path.join(self.recording_path,'rec_'+prefix),chanin=self.input_channels,chanout=self.output_channels,fs=self.sampling_rate)
-        rec_max = np.max(np.delete(rec_temp,chan_loop,axis=1)) if self.loopback is not None else np.max(rec_temp)
-        print(f"Maximum sample value = {rec_max}")
-        print(f"Extracting ---> {prefix} using sr = {self.sampling_rate}")
-        ir_temp = ir_extract(rec_temp,self.sweep_file,os.path.join(self.recording_path,'ir_'+prefix),loopback=chan_loop,fs=self.sampling_rate)
-        print(f"IR shape = {ir_temp.shape}")
+        if snr is not None:
+            # repite el sweep hasta alcanzar la SNR pedida
+            ir_temp, _, nrep = play_rec_adaptive(self.sweep_file,os.path.join(self.recording_path,'rec_'+prefix),
+                                                 os.path.join(self.recording_path,'ir_'+prefix),chanin=self.input_channels,
+                                                 chanout=self.output_channels,loopback=chan_loop,snr=snr,maxrep=maxrep,
+                                                 fs=self.sampling_rate)
+            print(f"IR shape = {ir_temp.shape} averaged over {nrep} repetitions")
+        else:
+            rec_temp = play_rec(self.sweep_file,os.path.join(self.recording_path,'rec_'+prefix),chanin=self.input_channels,chanout=self.output_channels,fs=self.sampling_rate)
+            rec_max = np.max(np.delete(rec_temp,chan_loop,axis=1)) if self.loopback is not None else np.max(rec_temp)
+            print(f"Maximum sample value = {rec_max}")
+            print(f"Extracting ---> {prefix} using sr = {self.sampling_rate}")
+            ir_temp = ir_extract(rec_temp,self.sweep_file,os.path.join(self.recording_path,'ir_'+prefix),loopback=chan_loop,fs=self.sampling_rate)
+            print(f"IR shape = {ir_temp.shape}")
         rec_dic = dict(
             spk=speaker,
             mic=microphone,
@@ -129,6 +137,20 @@ class RecordingSession:
             ir_list.append(self.load_ir(nrecording,ftype))
         return ir_list
 
+    def simulate_ir(self,room_dim,order=10,beta=0.9,height=1.2,dur=None,workers=None):
+        '''
+        Respuestas impulso predichas con fuentes imagen (room.shoebox_ir) en una sala rectangular room_dim
+        para las posiciones speaker_pos y microphone_pos de la sesion en metros ([x,y] o [x,y,z], si falta z
+        se usa height). Devuelve array nspeakers x nsamples x nmicrophones
+        '''
+        pos = []
+        for p in (self.speaker_pos,self.microphone_pos):
+            p = np.atleast_2d(np.asarray(p,dtype=float))
+            if p.shape[1] == 2:
+                p = np.hstack((p,np.full((p.shape[0],1),height)))
+            pos.append(p)
+        return shoebox_ir(room_dim,pos[0],pos[1],order=order,beta=beta,dur=dur,workers=workers,fs=self.sampling_rate)
+
     def generate_backup_file_prefix(self):
         return f"{self.session_id}_backup"
     
@@ -159,6 +181,7 @@ class RecordingSession:
             'hour': self.hour,
             'comments': self.comments,
             'sweepfile': self.sweep_file,
+            'sweepparams': self.sweep_params,
             'recording_path': self.recording_path,
             'recordings': self.recordings,
             'saved': self.saved
@@ -185,11 +208,19 @@ class RecordingSession:
         hour = metadata.get('hour')
         comments = metadata.get('comments', '')
         sweepfile = metadata.get('sweepfile')
+        sweepparams = metadata.get('sweepparams')
+        sweepkw = {}
+        if sweepparams is not None and not os.path.exists(str(sweepfile) + '_inv.npz'):
+            # sesion copiada de otra maquina: el sweep se vuelve a armar en la biblioteca local
+            sweepfile = None
+            sweepkw = dict(sweepdur=sweepparams['T'],sweeprange=[sweepparams['f1'],sweepparams['f2']],
+                           sweeprep=sweepparams['Nrep'],sweeppost=sweepparams['post'])
         recordingpath = metadata.get('recording_path')
         recordings = metadata.get('recordings', [])
         session = RecordingSession(session_id, speakers, microphones, speaker_pos, microphone_pos,
                                    inchan, outchan, loopback, sampling_rate, rtype, date, hour,
-                                   recordingpath, sweepfile)
+                                   recordingpath, sweepfile, **sweepkw)
+        session.sweep_params = sweepparams
         session.comments = comments
         session.recordings = recordings
         session.saved = metadata.get('saved', False)
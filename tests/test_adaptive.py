@@ -0,0 +1,51 @@
+import threading
+import numpy as np
+import pytest
+from irma import generate, process
+
+try:
+    from irma import io
+except (ImportError, OSError):
+    pytest.skip('sounddevice/PortAudio not available', allow_module_level=True)
+
+
+class FakeStream:
+    ''' full duplex en memoria: cada canal de entrada es la salida 1 mas ruido de desvio noise[k] '''
+    def __init__(self, noise, samplerate, channels, dtype, callback, blocksize=1024):
+        self.noise = noise
+        self.channels = channels
+        self.callback = callback
+        self.blocksize = blocksize
+        self.done = threading.Event()
+        self.rng = np.random.default_rng(0)
+
+    def _run(self):
+        nin, nout = self.channels
+        outdata = np.zeros((self.blocksize, nout))
+        while not self.done.is_set():
+            # la entrada es la salida del bloque anterior (latencia de un bloque)
+            indata = outdata[:, :1] + self.noise*self.rng.standard_normal((self.blocksize, nin))
+            outdata = np.zeros((self.blocksize, nout))
+            self.callback(indata, outdata, self.blocksize, None, None)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.done.set()
+        self.thread.join()
+
+
+def test_adaptive_snr_per_channel(tmp_path, monkeypatch):
+    # el canal 0 no llega a la SNR de RT20 pero ambos superan snr: debe parar en minrep
+    fname = str(tmp_path / 'sweep')
+    generate.sweep(1.0, 50, 16000, filename=fname, fs=48000, post=1.0)
+    process.clear_inverse_cache()
+    monkeypatch.setattr(io.sd, 'Stream', lambda **kw: FakeStream([0.05, 1e-4], **kw), raising=False)
+    ir, SNR, nrep = io.play_rec_adaptive(fname, str(tmp_path / 'rec'), chanin=[1, 2], snr=15.0,
+                                         minrep=2, maxrep=6, write_wav=False)
+    assert nrep == 2
+    assert np.all(SNR > 15.0)
+    assert SNR[1] > SNR[0] + 20
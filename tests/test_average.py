@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from scipy.io import wavfile
+from irma import generate, process
+
+
+def test_trimmed_drops_one_take_per_end():
+    # 5 tomas con un valor atipico: trim=0.1 daria 0 tomas por extremo, se descarta al menos una
+    ir_stack = np.array([1.0, 1.0, 1.0, 1.0, 11.0])[:, np.newaxis, np.newaxis]
+    ir, _ = process.ir_average(ir_stack, method='trimmed', trim=0.1)
+    assert ir[0, 0] == pytest.approx(1.0)
+    ir, _ = process.ir_average(ir_stack, method='trimmed', trim=0)
+    assert ir[0, 0] == pytest.approx(3.0)
+
+
+def test_ir_extract_forwards_trim(tmp_path):
+    fname = str(tmp_path / 'sweep')
+    generate.sweep(0.5, 50, 16000, filename=fname, fs=48000, Nrep=5, post=0.25)
+    process.clear_inverse_cache()
+    _, x = wavfile.read(fname + '.wav')
+    rec = x.astype(float)[:, np.newaxis]
+    N = len(rec)//5
+    rec[4*N:] *= 3 # una repeticion con el triple de ganancia
+    out = str(tmp_path / 'ir')
+    mean = process.ir_extract(rec, fname, out, average='mean')
+    trimmed = process.ir_extract(rec, fname, out, average='trimmed')
+    notrim = process.ir_extract(rec, fname, out, average='trimmed', trim=0)
+    assert np.max(np.abs(trimmed)) == pytest.approx(np.max(np.abs(mean))/1.4, rel=0.05)
+    np.testing.assert_allclose(notrim, mean, atol=1e-12)
@@ -0,0 +1,18 @@
+import numpy as np
+from irma import process
+
+
+def test_multirate_matches_full_rate(tmp_path):
+    # IR sintetica con el pico al comienzo: los transitorios de los diezmados no deben caer sobre ella
+    fs = 48000
+    rng = np.random.default_rng(0)
+    t = np.arange(int(1.5*fs))/fs
+    ir = rng.standard_normal(len(t))*np.exp(-6.9*t/0.8)
+    ir[:100] = 0
+    ir[100] = 3
+    process.make_filterbank(bankname=str(tmp_path / 'full'), fs=fs)
+    process.make_filterbank(bankname=str(tmp_path / 'multi'), fs=fs, multirate=True)
+    full = process.FilterBank.get(str(tmp_path / 'full')).filter(ir)[:, :, 0]
+    multi = process.FilterBank.get(str(tmp_path / 'multi')).filter(ir)[:, :, 0]
+    relerr = np.max(np.abs(full-multi), axis=1)/np.max(np.abs(full), axis=1)
+    assert np.all(relerr < 0.03)
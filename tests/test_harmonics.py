@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from irma import generate, process
+
+
+@pytest.fixture(scope='module')
+def sweepfile(tmp_path_factory):
+    fname = str(tmp_path_factory.mktemp('sweep') / 'sweep')
+    generate.sweep(2.0, 50, 16000, filename=fname, fs=48000, post=1.0)
+    process.clear_inverse_cache()
+    return fname
+
+
+def _excitation(fname):
+    datainv = process.load_inverse(fname)
+    sweep = np.zeros(int(datainv['nfft']))
+    from scipy.io import wavfile
+    _, data = wavfile.read(fname + '.wav')
+    sweep[:len(data)] = data[:len(sweep)]
+    return sweep
+
+
+@pytest.mark.parametrize('order', [2, 3])
+def test_harmonic_orders_are_not_swapped(sweepfile, order):
+    # y = x + 0.1 x^order: order 2 has the 2nd harmonic only, order 3 mostly the 3rd
+    x = _excitation(sweepfile)
+    y = x + 0.1*x**order
+    hd = process.ir_harmonics(y, sweepfile, K=3)
+    band = (hd['f'] > 300) & (hd['f'] < 3000)
+    HD2 = np.median(hd['HD'][0, band, 0])
+    HD3 = np.median(hd['HD'][1, band, 0])
+    if order == 2:
+        assert HD2 > -40 and HD3 < HD2 - 30
+    else:
+        assert HD3 > -50 and HD2 < HD3 - 30
+
+
+def test_harmonics_rejects_k1(sweepfile):
+    with pytest.raises(ValueError):
+        process.ir_harmonics(_excitation(sweepfile), sweepfile, K=1)
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from scipy.io import wavfile
+from irma import generate, process
+
+
+def _delayed(fname, delay):
+    _, x = wavfile.read(fname + '.wav')
+    return np.roll(x.astype(float), delay)[:, np.newaxis]
+
+
+def test_ir_multisine_lin_grid(tmp_path):
+    fname = str(tmp_path / 'ms')
+    generate.multisine(fname, T=0.5, f1=20, f2=20000, nper=2, grid='lin', crest_iter=5)
+    process.clear_inverse_cache()
+    ir = process.ir_extract(_delayed(fname, 480), fname, str(tmp_path / 'ir'))
+    assert np.argmax(np.abs(ir[:, 0])) == 480
+
+
+def test_ir_multisine_log_grid_is_refused(tmp_path):
+    fname = str(tmp_path / 'ms')
+    generate.multisine(fname, T=0.5, f1=20, f2=20000, nper=2, grid='log', nlines=200, crest_iter=5)
+    process.clear_inverse_cache()
+    with pytest.raises(ValueError):
+        process.ir_extract(_delayed(fname, 480), fname, str(tmp_path / 'ir'))
+    # la transferencia en las lineas es un retardo puro de 10 ms
+    tf = process.transfer_multisine(_delayed(fname, 480), fname)
+    np.testing.assert_allclose(tf['H'][:, 0], np.exp(-2j*np.pi*tf['f']*0.01), atol=1e-6)
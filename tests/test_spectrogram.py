@@ -0,0 +1,21 @@
+import numpy as np
+from scipy import signal
+from irma import process
+
+
+def test_spectrogram_blocks_match_array():
+    fs = 48000
+    t = np.arange(2*fs+123)/fs
+    rng = np.random.default_rng(1)
+    x = np.stack([np.sin(2*np.pi*300*t)*np.exp(-t), rng.standard_normal(len(t))*np.exp(-3*t)], 1)
+    x[:, 1] = signal.sosfilt(signal.butter(2, 100, 'hp', fs=fs, output='sos'), x[:, 1])
+    kw = dict(windowSize=1024, overlap=512, fs=fs, windowType='hann', logf=False, normalized=False)
+    a = process.spectrogram(x, **kw)
+    b = process.spectrogram((x[n:n+10000] for n in range(0, len(x), 10000)), **kw)
+    assert a['env'].shape == (2, len(x))
+    np.testing.assert_allclose(b['env'], a['env'], atol=1e-12)
+    np.testing.assert_allclose(b['s'], a['s'], atol=1e-12)
+    # la envolvente por bloques se aparta de signal.hilbert en ~1% lejos de los bordes
+    ref = np.abs(signal.hilbert(x, axis=0)).T
+    err = np.max(np.abs(a['env']-ref)[:, 2048:-2048], axis=1)/np.max(ref, axis=1)
+    assert np.all(err < 0.02)